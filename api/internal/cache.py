@@ -0,0 +1,89 @@
+from anthill.framework.conf import settings
+import collections
+import pickle
+import time
+
+__all__ = ['LocalCache', 'local_cache']
+
+
+INTERNAL_LOCAL_CACHE_MAX_ENTRIES = getattr(settings, 'INTERNAL_LOCAL_CACHE_MAX_ENTRIES', 1024)
+INTERNAL_LOCAL_CACHE_MAX_BYTES = getattr(settings, 'INTERNAL_LOCAL_CACHE_MAX_BYTES', 16 * 1024 * 1024)
+# Seconds entries live at most in the local cache, 0 disables it
+INTERNAL_LOCAL_CACHE_TIMEOUT = getattr(settings, 'INTERNAL_LOCAL_CACHE_TIMEOUT', 5)
+
+
+class LocalCache:
+    """
+    In-process LRU cache, bounded by number of entries and total bytes.
+    Values are kept pickled, so callers never share (and mutate) the
+    same object; their pickled size is what counts against max_bytes.
+    """
+
+    def __init__(self, max_entries=INTERNAL_LOCAL_CACHE_MAX_ENTRIES,
+                 max_bytes=INTERNAL_LOCAL_CACHE_MAX_BYTES, timeout=INTERNAL_LOCAL_CACHE_TIMEOUT):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.entries = collections.OrderedDict()  # key -> (expires, data)
+        self.size = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.timeout and self.max_entries and self.max_bytes)
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            return default
+        expires, data = entry
+        if expires <= time.time():
+            self.delete(key)
+            return default
+        self.entries.move_to_end(key)
+        return pickle.loads(data)
+
+    def set(self, key, value, timeout=None) -> None:
+        """
+        Caches the value for timeout seconds, but no longer than the
+        cache timeout. Values too big or not picklable are not cached.
+        """
+        if not self.enabled:
+            return
+        timeout = self.timeout if timeout is None else min(timeout, self.timeout)
+        if timeout <= 0:
+            return
+        try:
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return
+        self.delete(key)
+        if len(data) > self.max_bytes:
+            return
+        self.entries[key] = (time.time() + timeout, data)
+        self.size += len(data)
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            # Least recently used first
+            _, (_, dropped) = self.entries.popitem(last=False)
+            self.size -= len(dropped)
+
+    def delete(self, key) -> None:
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+    def delete_many(self, keys) -> None:
+        for key in keys:
+            self.delete(key)
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.size = 0
+
+
+local_cache = LocalCache()
@@ -1,15 +1,18 @@
-from tornado.gen import with_timeout
 from tornado.util import TimeoutError
 from tornado.ioloop import IOLoop
 from tornado.concurrent import Future
-from tornado.escape import utf8
+from tornado.locks import Semaphore
+from tornado.gen import multi
 
 from anthill.framework.testing.timing import ElapsedTime
 from anthill.framework.utils.singleton import Singleton
 from anthill.platform.core.messenger.channels.layers import get_channel_layer
 from anthill.platform.core.messenger.channels.exceptions import InvalidChannelLayerError
-from functools import wraps, partial
-import datetime
+from functools import wraps, partial, lru_cache
+from collections.abc import Sequence
+import asyncio
+import collections
+import heapq
 
 from anthill.framework.core.jsonrpc.exceptions import JSONRPCInvalidRequestException
 from anthill.framework.core.jsonrpc.jsonrpc import JSONRPCRequest
@@ -17,6 +20,7 @@ from anthill.framework.core.jsonrpc.manager import JSONRPCResponseManager
 from anthill.framework.core.jsonrpc.dispatcher import Dispatcher
 from anthill.framework.utils.asynchronous import as_future
 from anthill.framework.core.cache import cache
+from anthill.platform.api.internal.cache import local_cache
 from anthill.framework.conf import settings
 
 from typing import Optional
@@ -24,7 +28,10 @@ import inspect
 import json
 import logging
 import hashlib
-import copy
+import msgpack
+import math
+import random
+import time
 
 __all__ = [
     'BaseInternalConnection', 'InternalConnection', 'JSONRPCInternalConnection',
@@ -39,16 +46,84 @@ logger = logging.getLogger('anthill.application')
 DEFAULT_CACHE_TIMEOUT = getattr(settings, 'INTERNAL_DEFAULT_CACHE_TIMEOUT', 300)
 INTERNAL_REQUEST_CACHING = getattr(settings, 'INTERNAL_REQUEST_CACHING', True)
 INTERNAL_API_METHOD_CACHING = getattr(settings, 'INTERNAL_API_METHOD_CACHING', False)
+INTERNAL_API_ERROR_CACHE_TIMEOUT = getattr(settings, 'INTERNAL_API_ERROR_CACHE_TIMEOUT', 5)
+INTERNAL_MAX_PENDING_REQUESTS = getattr(settings, 'INTERNAL_MAX_PENDING_REQUESTS', None)
+# The higher, the earlier cached results are refreshed; 0 disables
+INTERNAL_CACHE_EARLY_EXPIRATION_BETA = getattr(settings, 'INTERNAL_CACHE_EARLY_EXPIRATION_BETA', 1.0)
+
+
+@lru_cache(maxsize=1024)
+def _cache_key_prefix(service, method):
+    return '.'.join(['internal.cache', service, method])
 
 
 def _cache_key(service, method, postfix=None):
-    parts = ['internal.cache', service, method]
+    prefix = _cache_key_prefix(service, method)
     if postfix:
-        parts.append(postfix)
-    return '.'.join(parts)
+        return prefix + '.' + postfix
+    return prefix
+
+
+def _dict_item_sort_key(item):
+    return type(item[0]).__name__, item[0]
+
+
+def _canonical(value):
+    """Same data for equal values, whatever the order of dict keys."""
+    if isinstance(value, dict):
+        return {k: _canonical(v) for k, v in sorted(value.items(), key=_dict_item_sort_key)}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    return value
+
+
+def _args_digest(args, kwargs, exclude=()) -> str:
+    """
+    Digest of call arguments for cache keys, the same for equal ones.
+    Raises TypeError, ValueError or OverflowError if they cannot be
+    serialized (to go over the wire, they have to be anyway).
+    """
+    kwargs = {k: v for k, v in kwargs.items() if k not in exclude}
+    data = msgpack.packb([_canonical(args), _canonical(kwargs)], use_bin_type=True)
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class CachedResult(collections.namedtuple('CachedResult', ['value', 'delta', 'expires'])):
+    """
+    Cached value along with the seconds it took to compute (delta)
+    and the time it expires at.
+    """
+
+    def expires_early(self, beta=INTERNAL_CACHE_EARLY_EXPIRATION_BETA) -> bool:
+        """
+        Probabilistic early expiration (XFetch): the closer to expiry and
+        the longer to recompute, the likelier to be considered expired,
+        so that a hot value is refreshed by a single caller before it
+        expires for all of them at once.
+        """
+        return time.time() - self.delta * beta * math.log(1.0 - random.random()) >= self.expires
+
+
+async def _cache_get(key):
+    """Gets the value from the local cache, or else from the shared one."""
+    value = local_cache.get(key)
+    if value is None:
+        value = await as_future(cache.get)(key)
+        if value is not None:
+            timeout = value.expires - time.time() if isinstance(value, CachedResult) else None
+            local_cache.set(key, value, timeout)
+    return value
+
+
+async def _cache_set(key, value, timeout):
+    local_cache.set(key, value, timeout)
+    await as_future(cache.set)(key, value, timeout)
 
 
 def _cached(key, timeout):
+    # Computations in progress by cache key
+    futures = {}
+
     def decorator(func):
         @wraps(func)
         async def wrapper(conn, service, method, *args, **kwargs):
@@ -56,13 +131,34 @@ def _cached(key, timeout):
             if not caching:
                 return await func(conn, service, method, *args, **kwargs)
             timeout_ = kwargs.pop('cache_timeout', timeout)
-            postfix = hashlib.md5(utf8(str(args) + str(kwargs))).hexdigest()
+            try:
+                # Request options, not arguments of the method
+                postfix = _args_digest(args, kwargs, exclude=('timeout', 'registered_services'))
+            except (TypeError, ValueError, OverflowError):
+                logger.warning('Cannot cache %s@%s result: arguments not serializable.' % (method, service))
+                return await func(conn, service, method, *args, **kwargs)
             k = key(service, method, postfix) if callable(key) else key
-            result = await as_future(cache.get)(k)
-            if result is None:
+            entry = await _cache_get(k)
+            if isinstance(entry, CachedResult) and (k in futures or not entry.expires_early()):
+                # Either fresh or being refreshed by someone else
+                return entry.value
+
+            async def compute():
+                started = time.time()
                 result = await func(conn, service, method, *args, **kwargs)
-                await as_future(cache.set)(k, result, timeout_)
-            return result
+                if result is not None:
+                    now = time.time()
+                    entry_ = CachedResult(result, now - started, now + timeout_)
+                    await _cache_set(k, entry_, timeout_)
+                return result
+
+            # Concurrent callers with the same key share one computation
+            future = futures.get(k)
+            if future is None:
+                future = futures[k] = asyncio.ensure_future(compute())
+                future.add_done_callback(lambda f: futures.pop(k, None))
+            # Not cancelled along with this caller, others wait for it too
+            return await asyncio.shield(future)
         return wrapper
     return decorator
 
@@ -90,6 +186,8 @@ class InternalAPI(Singleton):
     """Internal API methods."""
 
     methods = []
+    # Methods caching their results
+    cached_methods = []
 
     def __init__(self):
         self.service = None
@@ -114,39 +212,87 @@ class InternalAPI(Singleton):
         for method in methods:
             self.add_method(method)
 
+    def cache_version_key(self, namespace):
+        return '.'.join(['internal.cache_version', self.service.name, namespace])
+
+    async def get_cache_version(self, namespace) -> int:
+        return await _cache_get(self.cache_version_key(namespace)) or 0
+
+    async def invalidate_cache_namespace(self, namespace) -> None:
+        """
+        Makes all cached results of the namespace stale at once,
+        by moving on the version their cache keys are made with.
+        """
+        key = self.cache_version_key(namespace)
+        await as_future(cache.add)(key, 0, None)
+        await as_future(cache.incr)(key)
+        await self.service.internal_connection.invalidate_local_cache([key])
+
     def as_internal(self, enable_cache=INTERNAL_API_METHOD_CACHING,
-                    cache_timeout=DEFAULT_CACHE_TIMEOUT, cache_key=_cache_key):
-        """Decorator marks function as an internal api method."""
+                    cache_timeout=DEFAULT_CACHE_TIMEOUT, cache_key=_cache_key,
+                    cache_empty=False, error_cache_timeout=INTERNAL_API_ERROR_CACHE_TIMEOUT,
+                    cache_namespace=None, invalidates=None):
+        """
+        Decorator marks function as an internal api method.
+        Caching policy (methods declared with invalidates are never cached,
+        as they change state):
+        cache_empty -- cache empty results (None, [], {}...) as well;
+        error_cache_timeout -- seconds to cache error results for, 0 not to cache them;
+        cache_namespace -- callable giving the namespace of the cached result,
+            from the method arguments;
+        invalidates -- callable giving, from the method arguments, the namespace
+            the method makes stale.
+        """
 
         def decorator(func):
-            def get_cache_key(api_, *args, **kwargs):
+            caching = enable_cache and invalidates is None
+
+            async def get_cache_key(api_, *args, **kwargs):
                 if callable(cache_key):
-                    kwargs = copy.deepcopy(kwargs)
-                    del kwargs['service']
-                    method = func.__name__
-                    postfix = hashlib.md5(utf8(str(args) + str(kwargs))).hexdigest()
-                    return cache_key(self.service.name, method, postfix)
-                return cache_key
+                    # Calling service does not make a difference
+                    postfix = _args_digest(args, kwargs, exclude=('service',))
+                    key = cache_key(self.service.name, func.__name__, postfix)
+                else:
+                    key = cache_key
+                if cache_namespace is not None:
+                    version = await self.get_cache_version(cache_namespace(*args, **kwargs))
+                    key = '%s.v%s' % (key, version)
+                return key
 
             if inspect.iscoroutinefunction(func):
                 async def wrapper(api_, *args, **kwargs):
                     key = None
-                    if enable_cache:
-                        key = get_cache_key(api_, *args, **kwargs)
-                        result = await as_future(cache.get)(key)
-                        if result:
-                            return result
+                    if caching:
+                        try:
+                            key = await get_cache_key(api_, *args, **kwargs)
+                        except (TypeError, ValueError, OverflowError):
+                            logger.warning('Cannot cache %s result: arguments not serializable.' % func.__name__)
+                        else:
+                            entry = await _cache_get(key)
+                            if isinstance(entry, CachedResult):
+                                return entry.value
+                    started = time.time()
                     try:
                         result = await func(api_, *args, **kwargs)
                     except Exception as e:
-                        return {'error': {'message': str(e)}}
+                        result = {'error': {'message': str(e)}}
+                        timeout = error_cache_timeout
                     else:
-                        if enable_cache:
-                            await as_future(cache.set)(key, result, cache_timeout)
-                        return result
+                        timeout = cache_timeout if result or cache_empty else None
+                        # Nothing to invalidate if no method caches its results
+                        if invalidates is not None and self.cached_methods:
+                            try:
+                                await self.invalidate_cache_namespace(invalidates(*args, **kwargs))
+                            except Exception as e:
+                                # The method itself has succeeded anyway
+                                logger.error('Cannot invalidate %s cache. %s' % (func.__name__, str(e)))
+                    if key is not None and timeout:
+                        now = time.time()
+                        await _cache_set(key, CachedResult(result, now - started, now + timeout), timeout)
+                    return result
             else:
                 def wrapper(api_, *args, **kwargs):
-                    if enable_cache:
+                    if caching or invalidates is not None:
                         logger.warning('Caching cannot be enabled. Make api method async.')
                     try:
                         result = func(api_, *args, **kwargs)
@@ -156,6 +302,8 @@ class InternalAPI(Singleton):
                         return result
             wrapper = wraps(func)(wrapper)
             self.add_method(wrapper)
+            if caching and inspect.iscoroutinefunction(func):
+                self.cached_methods.append(wrapper.__name__)
             return wrapper
 
         return decorator
@@ -165,20 +313,102 @@ api = InternalAPI()
 as_internal = api.as_internal
 
 
+class PendingRequests:
+    """
+    Correlates requests with their responses.
+    All deadlines share one IOLoop timeout, set for the earliest of them.
+    If max_pending is set, requests over that number in flight wait for
+    a free slot.
+    """
+
+    def __init__(self, max_pending=None):
+        self.futures = {}
+        self.services = {}
+        # Number of requests in flight by service name
+        self.outstanding = collections.Counter()
+        self._deadlines = []  # heap of (deadline, request_id)
+        self._timeout = None
+        self._timeout_deadline = None
+        self._semaphore = Semaphore(max_pending) if max_pending else None
+
+    def __len__(self):
+        return len(self.futures)
+
+    async def add(self, request_id, service: str, timeout: float) -> Future:
+        """
+        Registers the request and returns the future of its result, failing
+        with TimeoutError after timeout seconds. Must be paired with remove.
+        """
+        if self._semaphore is not None:
+            await self._semaphore.acquire()
+        self.futures[request_id] = future = Future()
+        self.services[request_id] = service
+        self.outstanding[service] += 1
+        deadline = IOLoop.current().time() + timeout
+        heapq.heappush(self._deadlines, (deadline, request_id))
+        self._schedule(deadline)
+        return future
+
+    def remove(self, request_id) -> None:
+        """Forgets the request, whether answered, timed out or cancelled."""
+        future = self.futures.pop(request_id, None)
+        if future is None:
+            return
+        if not future.done():
+            future.cancel()
+        service = self.services.pop(request_id)
+        self.outstanding[service] -= 1
+        if not self.outstanding[service]:
+            del self.outstanding[service]
+        if self._semaphore is not None:
+            self._semaphore.release()
+
+    def resolve(self, request_id, result) -> None:
+        future = self.futures.get(request_id)
+        if future is not None and not future.done():
+            future.set_result(result)
+
+    def _schedule(self, deadline):
+        if self._timeout_deadline is not None and self._timeout_deadline <= deadline:
+            return
+        io_loop = IOLoop.current()
+        if self._timeout is not None:
+            io_loop.remove_timeout(self._timeout)
+        self._timeout_deadline = deadline
+        self._timeout = io_loop.call_at(deadline, self._expire)
+
+    def _expire(self):
+        self._timeout = self._timeout_deadline = None
+        now = IOLoop.current().time()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, request_id = heapq.heappop(self._deadlines)
+            # Already removed requests are just dropped from the heap
+            future = self.futures.get(request_id)
+            if future is not None and not future.done():
+                future.set_exception(TimeoutError())
+        if self._deadlines:
+            self._schedule(self._deadlines[0][0])
+
+
 class BaseInternalConnection(Singleton):
     """Implements communications between services."""
     message_type = 'internal'
     channel_alias = 'internal'
     channel_group_name_prefix = 'internal'
+    # Channel group of all services, local cache invalidations go to
+    cache_invalidation_group = 'cache-invalidation'
     request_timeout = 10
+    max_pending_requests = INTERNAL_MAX_PENDING_REQUESTS
 
     def __init__(self, service=None):
         self.channel_layer = None
         self.channel_name = None
         self.channel_receive = None
         self.service = service
-        self._responses = {}
+        self._responses = PendingRequests(self.max_pending_requests)
         self._current_request_id = 0
+        # Channel groups of other services joined
+        self.groups = set()
         super().__init__()
 
     def channel_group_name(self, service=None) -> str:
@@ -201,15 +431,28 @@ class BaseInternalConnection(Singleton):
             self.channel_name = await self.channel_layer.new_channel(prefix=self.service.app.label)
             self.channel_receive = partial(self.channel_layer.receive, self.channel_name)
             await self.channel_layer.group_add(self.channel_group_name(), self.channel_name)
+            await self.group_add(self.cache_invalidation_group)
             logger.debug('Internal api connection status: CONNECTED.')
         else:
             logger.debug('Internal api connection status: NOT_CONNECTED.')
 
     async def disconnect(self) -> None:
+        for service in list(self.groups):
+            await self.group_discard(service)
         await self.channel_layer.group_discard(
             self.channel_group_name(), self.channel_name)
         logger.debug('Internal api connection status: DISCONNECTED.')
 
+    async def group_add(self, service: str) -> None:
+        """Join service channel group, to receive messages sent to it as well."""
+        await self.channel_layer.group_add(self.channel_group_name(service), self.channel_name)
+        self.groups.add(service)
+
+    async def group_discard(self, service: str) -> None:
+        """Leave service channel group joined with group_add."""
+        await self.channel_layer.group_discard(self.channel_group_name(service), self.channel_name)
+        self.groups.discard(service)
+
     async def group_send(self, service: str, message: dict) -> None:
         """Send message to service channel group."""
         try:
@@ -222,11 +465,28 @@ class BaseInternalConnection(Singleton):
         """Send message to service channel."""
         await self.channel_layer.send(channel, message)
 
+    async def invalidate_cache(self, keys: list) -> None:
+        """Drop cached results from the shared cache and local caches of all services."""
+        keys = list(keys)
+        await as_future(cache.delete_many)(keys)
+        await self.invalidate_local_cache(keys)
+
+    async def invalidate_local_cache(self, keys: list) -> None:
+        """Drop cached results from local caches of all services."""
+        keys = list(keys)
+        local_cache.delete_many(keys)
+        await self.push(self.cache_invalidation_group, 'invalidate_local_cache', keys=keys)
+
     def next_request_id(self):
         """Generate new request id."""
         self._current_request_id += 1
         return self._current_request_id
 
+    @property
+    def outstanding_requests(self) -> dict:
+        """Number of requests waiting for response by service name."""
+        return dict(self._responses.outstanding)
+
     async def on_request(self, payload: dict, channel: str) -> None:
         raise NotImplementedError
 
@@ -243,6 +503,53 @@ class BaseInternalConnection(Singleton):
         """Request for method and wait for result."""
         raise NotImplementedError
 
+    async def request_batch(self, service: str, calls: list, timeout: int = None) -> list:
+        """Request for several (method, kwargs) calls at once and wait for results."""
+        raise NotImplementedError
+
+    async def gather_requests(self, calls: list, timeout: float = None, deadline: float = None,
+                              max_concurrency: int = None, callback=None, **kwargs) -> list:
+        """
+        Requests several (service, method, kwargs) calls concurrently.
+        Every call waits for at most timeout seconds, all of them together
+        for at most deadline seconds, and no more than max_concurrency
+        calls are in flight at once. Extra kwargs go to every request.
+        Returns the results in call order; a failed call, or one left over
+        when the deadline is up, gives its exception instead of the result.
+        If callback is given, it is called with the call index, the result
+        and the seconds the call took as soon as each call is done.
+        """
+        io_loop = IOLoop.current()
+        timeout = timeout or self.request_timeout
+        end = io_loop.time() + deadline if deadline is not None else None
+        semaphore = Semaphore(max_concurrency) if max_concurrency else None
+        results = [None] * len(calls)
+
+        async def gather_one(i, service, method, call_kwargs):
+            if semaphore is not None:
+                await semaphore.acquire()
+            started = io_loop.time()
+            try:
+                timeout_ = timeout
+                if end is not None:
+                    timeout_ = min(timeout, end - io_loop.time())
+                    if timeout_ <= 0:
+                        raise RequestTimeoutError(
+                            'Service `%s` not requested within %s sec' % (service, deadline))
+                results[i] = await self.request(
+                    service, method, timeout=timeout_, **dict(kwargs, **call_kwargs))
+            except Exception as e:
+                # Whatever the failure, the other results are kept
+                results[i] = e
+            finally:
+                if semaphore is not None:
+                    semaphore.release()
+            if callback is not None:
+                callback(i, results[i], io_loop.time() - started)
+
+        await multi([gather_one(i, *call) for i, call in enumerate(calls)])
+        return results
+
     async def push(self, service: str, method: str, **kwargs) -> None:
         """Request for method with no wait for result."""
         raise NotImplementedError
@@ -258,16 +565,22 @@ class JSONRPCInternalConnection(BaseInternalConnection):
         for method_name in api:
             self.dispatcher.add_method(getattr(api, method_name))
 
-    async def on_request(self, payload: dict, channel: str) -> None:
-        payload = json.dumps(payload)
+    async def _handle_request(self, payload: dict):
+        # Payload is already decoded by the channel layer,
+        # so build the request right from it.
         try:
-            json_rpc_request = JSONRPCRequest.from_json(payload)
-        except (TypeError, ValueError, JSONRPCInvalidRequestException):
-            response = await JSONRPCResponseManager.handle(payload, self.dispatcher)
+            json_rpc_request = JSONRPCRequest.from_data(payload)
+        except (TypeError, ValueError, KeyError, JSONRPCInvalidRequestException):
+            # Invalid request, let the manager make up the error response.
+            response = await JSONRPCResponseManager.handle(json.dumps(payload), self.dispatcher)
         else:
             json_rpc_request.params = json_rpc_request.params or {}
             response = await JSONRPCResponseManager.handle_request(
                 json_rpc_request, self.dispatcher)
+        return response
+
+    async def on_request(self, payload: dict, channel: str) -> None:
+        response = await self._handle_request(payload)
 
         # No reply needed if response is None (in case of push).
         if response is None:
@@ -281,30 +594,47 @@ class JSONRPCInternalConnection(BaseInternalConnection):
 
         await self.send(channel, msg)  # send response
 
+    async def on_batch_request(self, payload: list, channel: str, batch_id) -> None:
+        """Dispatches the calls of a batch concurrently, replies in one message."""
+        responses = await multi([self._handle_request(item) for item in payload])
+        # Pushes get no response
+        data = [response.data for response in responses if response is not None]
+        if not data:
+            return
+
+        msg = {
+            'type': self.message_type,
+            'service': self.service.name,
+            'batch': batch_id,
+            'payload': data
+        }
+
+        await self.send(channel, msg)  # send response
+
+    async def on_batch_result(self, payload: list, batch_id) -> None:
+        self._responses.resolve(batch_id, payload)
+
     async def on_result(self, payload: dict) -> None:
         request_id = payload.get('id')
-        try:
-            future = self._responses[request_id]
-        except KeyError:
-            pass  # ¯\_(ツ)_/¯
-        else:
-            result = payload['result']
-            future.set_result(result)
+        self._responses.resolve(request_id, payload['result'])
 
     async def on_error(self, payload: dict) -> None:
         request_id = payload.get('id')
-        try:
-            future = self._responses[request_id]
-        except KeyError:
-            pass  # ¯\_(ツ)_/¯
-        else:
-            del payload['error']['code']
-            error = dict(error=payload['error'])
-            future.set_result(error)
+        if request_id in self._responses.futures:
+            # Payload may be shared with other receivers, leave it as it is
+            error = {key: value for key, value in payload['error'].items() if key != 'code'}
+            self._responses.resolve(request_id, dict(error=error))
 
     async def on_message(self, message: dict) -> None:
         payload = message['payload']
-        if 'result' in payload:
+        # Any sequence, not only lists, so that read-only payloads get through as well
+        if isinstance(payload, Sequence) and not isinstance(payload, (str, bytes)):
+            if any('method' in item for item in payload):
+                await self.on_batch_request(
+                    payload, channel=message['channel'], batch_id=message.get('batch'))
+            else:
+                await self.on_batch_result(payload, batch_id=message.get('batch'))
+        elif 'result' in payload:
             await self.on_result(payload)
         elif 'error' in payload:
             await self.on_error(payload)
@@ -344,11 +674,11 @@ class JSONRPCInternalConnection(BaseInternalConnection):
                     'id': request_id
                 }
             }
-            self._responses[request_id] = future = Future()
-            await self.group_send(service, message)
             timeout = timeout or self.request_timeout
+            future = await self._responses.add(request_id, service, timeout)
             try:
-                result = await with_timeout(datetime.timedelta(seconds=timeout), future)
+                await self.group_send(service, message)
+                result = await future
             except TimeoutError:
                 raise RequestTimeoutError(
                     'Service `%s` not responded for %s sec' % (service, timeout))
@@ -358,7 +688,59 @@ class JSONRPCInternalConnection(BaseInternalConnection):
                     raise RequestError(result)
                 return result
             finally:
-                del self._responses[request_id]
+                self._responses.remove(request_id)
+
+    async def request_batch(self, service: str, calls: list, timeout: int = None,
+                            registered_services=None) -> list:
+        """
+        Requests several methods of the service in a single message.
+        Takes a list of (method, kwargs) pairs and returns their results in
+        the same order; a failed call gives an `{'error': ...}` item
+        instead of raising RequestError.
+        """
+        self.check_service(service, registered_services)
+        if not calls:
+            return []
+        with ElapsedTime('request_batch@InternalConnection -> {0}', service):
+            batch_id = self.next_request_id()
+            request_ids = []
+            payload = []
+            for method, kwargs in calls:
+                request_id = self.next_request_id()
+                request_ids.append(request_id)
+                payload.append({
+                    'jsonrpc': self.json_rpc_ver,
+                    'method': method,
+                    'params': dict(kwargs, service=self.service.name),
+                    'id': request_id
+                })
+            message = {
+                'type': self.message_type,
+                'service': self.service.name,
+                'channel': self.channel_name,
+                'batch': batch_id,
+                'payload': payload
+            }
+            timeout = timeout or self.request_timeout
+            future = await self._responses.add(batch_id, service, timeout)
+            try:
+                await self.group_send(service, message)
+                responses = await future
+            except TimeoutError:
+                raise RequestTimeoutError(
+                    'Service `%s` not responded for %s sec' % (service, timeout))
+            finally:
+                self._responses.remove(batch_id)
+
+        results = {}
+        for response in responses:
+            if 'error' in response:
+                error = dict(response['error'])
+                error.pop('code', None)
+                results[response.get('id')] = dict(error=error)
+            else:
+                results[response.get('id')] = response['result']
+        return [results.get(request_id) for request_id in request_ids]
 
     async def push(self, service: str, method: str, registered_services=None, **kwargs) -> None:
         self.check_service(service, registered_services)
@@ -391,6 +773,14 @@ class InternalAPIMixin:
     def internal_request(self):
         return self.internal_connection.request
 
+    @property
+    def internal_request_batch(self):
+        return self.internal_connection.request_batch
+
+    @property
+    def internal_gather_requests(self):
+        return self.internal_connection.gather_requests
+
     @property
     def internal_push(self):
         return self.internal_connection.push
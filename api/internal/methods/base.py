@@ -1,4 +1,5 @@
 from ..core import as_internal, InternalAPI
+from ..cache import local_cache
 from typing import Optional
 
 
@@ -22,6 +23,11 @@ def get_service_metadata(api: InternalAPI, **options):
     return api.service.app.metadata
 
 
+@as_internal()
+def invalidate_local_cache(api: InternalAPI, keys: list, **options):
+    local_cache.delete_many(keys)
+
+
 @as_internal()
 def reload(api: InternalAPI, **options):
     import tornado.autoreload
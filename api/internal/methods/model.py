@@ -3,6 +3,11 @@ from ..core import as_internal, InternalAPI
 from typing import Optional
 
 
+def model_cache_namespace(model_name: str, *args, **kwargs):
+    """Cached results of all model methods go stale on model changes."""
+    return 'model.%s' % model_name
+
+
 def get_model_class(model_name: str):
     from anthill.framework.apps import app
     return app.get_model(model_name)
@@ -44,7 +49,7 @@ def deserialize_data(model, **data):
     return obj
 
 
-@as_internal()
+@as_internal(cache_namespace=model_cache_namespace)
 async def model_version(api: InternalAPI,
                         model_name: str,
                         object_id: str,
@@ -55,7 +60,7 @@ async def model_version(api: InternalAPI,
     return await future_exec(obj.versions.get, version)
 
 
-@as_internal()
+@as_internal(invalidates=model_cache_namespace)
 async def model_recover(api: InternalAPI,
                         model_name: str,
                         object_id: str,
@@ -67,7 +72,7 @@ async def model_recover(api: InternalAPI,
     await future_exec(version.revert)
 
 
-@as_internal()
+@as_internal(cache_namespace=model_cache_namespace)
 async def model_history(api: InternalAPI,
                         model_name: str,
                         object_id: str,
@@ -77,7 +82,7 @@ async def model_history(api: InternalAPI,
     return obj.versions
 
 
-@as_internal()
+@as_internal(cache_namespace=model_cache_namespace)
 async def get_model(api: InternalAPI,
                     model_name: str,
                     object_id: str,
@@ -87,7 +92,7 @@ async def get_model(api: InternalAPI,
     return obj.dump()
 
 
-@as_internal()
+@as_internal(cache_namespace=model_cache_namespace)
 async def get_models(api: InternalAPI,
                      model_name: str,
                      filter_data: Optional[dict] = None,
@@ -109,7 +114,7 @@ async def get_models(api: InternalAPI,
     return model.dump_many(objects)
 
 
-@as_internal()
+@as_internal(invalidates=model_cache_namespace)
 async def update_or_create_model(api: InternalAPI,
                                  model_name: str,
                                  data: dict,
@@ -119,7 +124,7 @@ async def update_or_create_model(api: InternalAPI,
     return obj.dump()
 
 
-@as_internal()
+@as_internal(invalidates=model_cache_namespace)
 async def delete_model(api: InternalAPI,
                        model_name: str,
                        object_id: str,
@@ -0,0 +1,70 @@
+"""
+Benchmark of internal API cache key computation.
+
+Compares the canonical msgpack + blake2b keys against the former ones,
+built from a deep copy of the kwargs and the md5 of their str(), on a
+few realistic argument payloads.
+
+    python benchmarks/internal_cache_keys.py [--rounds 20000]
+"""
+from anthill.platform.api.internal.core import _args_digest, _cache_key
+from tornado.escape import utf8
+import argparse
+import copy
+import hashlib
+import time
+
+
+PAYLOADS = {
+    "small": {"service": "game", "user_id": 12345},
+    "medium": {
+        "service": "game",
+        "user_id": 12345,
+        "filters": {"status": "active", "region": "eu", "tags": ["pvp", "ranked"]},
+        "page": 3,
+        "page_size": 50,
+    },
+    "large": {
+        "service": "game",
+        "ids": list(range(200)),
+        "profile": {
+            "name": "player",
+            "stats": {"level%d" % i: {"score": i * 10, "time": i * 1.5} for i in range(20)},
+        },
+    },
+}
+
+
+def former_key(kwargs):
+    kwargs = copy.deepcopy(kwargs)
+    del kwargs["service"]
+    postfix = hashlib.md5(utf8(str(()) + str(kwargs))).hexdigest()
+    return _cache_key("benchmark", "method", postfix)
+
+
+def canonical_key(kwargs):
+    postfix = _args_digest((), kwargs, exclude=("service",))
+    return _cache_key("benchmark", "method", postfix)
+
+
+def run(name, kwargs, rounds):
+    timings = []
+    for make_key in (former_key, canonical_key):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            make_key(kwargs)
+        timings.append((time.perf_counter() - start) / rounds * 1e6)
+    print("%-6s arguments: former %7.2f us  canonical %7.2f us  (x%4.1f)" % (
+        name, timings[0], timings[1], timings[0] / timings[1]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=20000)
+    args = parser.parse_args()
+    for name, kwargs in PAYLOADS.items():
+        run(name, kwargs, args.rounds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Benchmark of internal request dispatch on the receiving side.
+
+Compares building the JSON-RPC request straight from the payload decoded
+by the channel layer against encoding it to JSON and parsing it back, as
+on_request used to do. The method called does nothing, so the numbers
+are those of the dispatch itself.
+
+    python benchmarks/internal_dispatch.py [--requests 20000]
+"""
+from anthill.framework.core.jsonrpc.dispatcher import Dispatcher
+from anthill.framework.core.jsonrpc.manager import JSONRPCResponseManager
+from anthill.platform.api.internal.core import JSONRPCInternalConnection
+from tornado.ioloop import IOLoop
+import argparse
+import json
+import time
+
+
+async def benchmark_echo(service=None, **kwargs):
+    return kwargs
+
+
+def make_payload(request_id):
+    return {
+        "jsonrpc": "2.0",
+        "id": request_id,
+        "method": "benchmark_echo",
+        "params": {
+            "service": "benchmark",
+            "user_id": 12345,
+            "filters": {"status": "active", "tags": ["a", "b", "c"]},
+            "ids": list(range(20)),
+        },
+    }
+
+
+async def from_json(connection, payload):
+    return await JSONRPCResponseManager.handle(json.dumps(payload), connection.dispatcher)
+
+
+async def from_data(connection, payload):
+    return await connection._handle_request(payload)
+
+
+async def run(connection, handle, requests):
+    payloads = [make_payload(i) for i in range(requests)]
+    start = time.perf_counter()
+    for payload in payloads:
+        response = await handle(connection, payload)
+        assert "result" in response.data, response.data
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=20000)
+    args = parser.parse_args()
+    dispatcher = Dispatcher()
+    dispatcher.add_method(benchmark_echo)
+    connection = JSONRPCInternalConnection(dispatcher=dispatcher)
+    io_loop = IOLoop.current()
+    for name, handle in (("json round trip", from_json), ("decoded payload", from_data)):
+        elapsed = io_loop.run_sync(lambda: run(connection, handle, args.requests))
+        print("%-16s %6d requests: %9.0f requests/s" % (name, args.requests, args.requests / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Benchmark of internal request/response correlation with many requests
+in flight at once.
+
+Compares PendingRequests, with one timeout for all the deadlines, against
+a future and a with_timeout handle per request, as the connection used
+to do. Every request is registered, answered and cleaned up.
+
+    python benchmarks/internal_pending_requests.py [--requests 10000]
+"""
+from anthill.platform.api.internal.core import PendingRequests
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from tornado.gen import multi, with_timeout
+from datetime import timedelta
+import argparse
+import asyncio
+import time
+
+
+TIMEOUT = 10
+
+
+class PerRequestTimeouts:
+    """Future and timeout per request, as before PendingRequests."""
+
+    def __init__(self):
+        self.futures = {}
+
+    def __len__(self):
+        return len(self.futures)
+
+    def in_flight(self):
+        return list(self.futures)
+
+    async def call(self, request_id):
+        self.futures[request_id] = future = Future()
+        try:
+            return await with_timeout(timedelta(seconds=TIMEOUT), future)
+        finally:
+            del self.futures[request_id]
+
+    def resolve(self, request_id, result):
+        self.futures[request_id].set_result(result)
+
+
+class Correlated:
+    def __init__(self, max_pending):
+        self.pending = PendingRequests(max_pending)
+
+    def __len__(self):
+        return len(self.pending)
+
+    def in_flight(self):
+        return list(self.pending.futures)
+
+    async def call(self, request_id):
+        future = await self.pending.add(request_id, 'benchmark', TIMEOUT)
+        try:
+            return await future
+        finally:
+            self.pending.remove(request_id)
+
+    def resolve(self, request_id, result):
+        self.pending.resolve(request_id, result)
+
+
+async def run(engine, requests):
+    start = time.perf_counter()
+    calls = multi([engine.call(i) for i in range(requests)])
+    answered = set()
+    while len(answered) < requests:
+        # Answer whatever is in flight, as responses would come in
+        await asyncio.sleep(0)
+        for request_id in engine.in_flight():
+            if request_id not in answered:
+                engine.resolve(request_id, request_id)
+                answered.add(request_id)
+    await calls
+    elapsed = time.perf_counter() - start
+    assert not len(engine)
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=10000)
+    parser.add_argument("--max-pending", type=int, default=None)
+    args = parser.parse_args()
+    io_loop = IOLoop.current()
+    for name, make_engine in (
+            ("timeout per request", PerRequestTimeouts),
+            ("PendingRequests", lambda: Correlated(args.max_pending))):
+        elapsed = io_loop.run_sync(lambda: run(make_engine(), args.requests))
+        print("%-20s %6d requests: %8.2f ms  %9.0f requests/s" % (
+            name, args.requests, elapsed * 1000, args.requests / elapsed))
+
+
+if __name__ == "__main__":
+    main()
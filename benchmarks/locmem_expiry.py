@@ -0,0 +1,72 @@
+"""
+Benchmark of the locmem channel layer with many channels.
+
+Each channel holds one message and belongs to a group. The cost per
+receive and per group_send should stay flat as the number of channels
+grows, since expiry no longer scans every channel and group.
+
+    python benchmarks/locmem_expiry.py [--channels 1000 50000]
+"""
+from anthill.platform.core.messenger.channels.layers.backends.locmem import ChannelLayer
+from tornado.ioloop import IOLoop
+import argparse
+import time
+
+
+MESSAGE = {"type": "test.message", "text": "Hello", "values": list(range(10))}
+
+
+async def fill(layer, channels, groups):
+    for i in range(channels):
+        channel = "bench.channel%d" % i
+        await layer.group_add("bench.group%d" % (i % groups), channel)
+        await layer.send(channel, MESSAGE)
+
+
+async def run(channels, groups, rounds):
+    layer = ChannelLayer(capacity=rounds + 1)
+    start = time.perf_counter()
+    await fill(layer, channels, groups)
+    fill_time = time.perf_counter() - start
+
+    # Receive on a channel of its own, among all the others
+    start = time.perf_counter()
+    for _ in range(rounds):
+        await layer.send("bench.hot", MESSAGE)
+        await layer.receive("bench.hot")
+    receive_time = time.perf_counter() - start
+
+    # Groups of channels // groups members each
+    start = time.perf_counter()
+    for i in range(rounds // 10):
+        await layer.group_send("bench.group%d" % (i % groups), MESSAGE)
+    group_send_time = time.perf_counter() - start
+
+    # Everything expires at once
+    layer = ChannelLayer(expiry=0, group_expiry=0)
+    await fill(layer, channels, groups)
+    start = time.perf_counter()
+    layer._clean_expired()
+    expire_time = time.perf_counter() - start
+
+    print("%7d channels: fill %8.0f/s  send+receive %8.0f/s  group_send %8.2f ms  expire all %8.0f/s" % (
+        channels,
+        channels / fill_time,
+        rounds / receive_time,
+        group_send_time / (rounds // 10) * 1000,
+        channels / expire_time,
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--channels", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--groups", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=10000)
+    args = parser.parse_args()
+    for channels in args.channels:
+        IOLoop.current().run_sync(lambda: run(channels, args.groups, args.rounds))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Benchmark of the redis channel layer connection handling.
+
+Measures messages per second sent and received through a Redis server
+with pooled connections, and with a new connection per operation as the
+layer used to do. Needs a Redis server.
+
+    python benchmarks/redis_connections.py [--address localhost:6379]
+"""
+from anthill.platform.core.messenger.channels.layers.backends.redis import ChannelLayer
+import aioredis
+import argparse
+import asyncio
+import time
+
+
+MESSAGE = {"type": "test.message", "text": "Hello", "values": list(range(10))}
+
+
+class UnpooledConnectionContextManager:
+    """
+    Opens a connection on enter and closes it on exit, as before pooling.
+    """
+
+    def __init__(self, layer, index, blocking=False):
+        self.layer = layer
+        self.index = index
+        self.conn = None
+
+    async def __aenter__(self):
+        self.conn = await aioredis.create_redis(**self.layer.hosts[self.index])
+        return self.conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.conn.close()
+        await self.conn.wait_closed()
+
+
+class UnpooledChannelLayer(ChannelLayer):
+    ConnectionContextManager = UnpooledConnectionContextManager
+
+
+async def run(layer_class, address, messages, concurrency):
+    layer = layer_class(hosts=[address], capacity=messages + 1, pool_maxsize=concurrency)
+    await layer.flush()
+    channel = "bench.connections"
+
+    async def send(count):
+        for _ in range(count):
+            await layer.send(channel, MESSAGE)
+
+    async def receive(count):
+        for _ in range(count):
+            await layer.receive(channel)
+
+    counts = [messages // concurrency] * concurrency
+    start = time.perf_counter()
+    await asyncio.gather(*[send(count) for count in counts])
+    send_time = time.perf_counter() - start
+    start = time.perf_counter()
+    await asyncio.gather(*[receive(count) for count in counts])
+    receive_time = time.perf_counter() - start
+    await layer.flush()
+    await layer.close()
+    print("%-22s concurrency %3d: send %8.0f/s  receive %8.0f/s" % (
+        layer_class.__name__, concurrency, sum(counts) / send_time, sum(counts) / receive_time))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--address", default="localhost:6379")
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 50])
+    args = parser.parse_args()
+    host, port = args.address.rsplit(":", 1)
+    address = (host, int(port))
+    loop = asyncio.get_event_loop()
+    for concurrency in args.concurrency:
+        for layer_class in (UnpooledChannelLayer, ChannelLayer):
+            loop.run_until_complete(run(layer_class, address, args.messages, concurrency))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Microbenchmark of group_send fan-out encoding in the redis channel layer.
+
+Compares serializing the message once per member channel, with its name
+inside (as done before the routing envelope), against serializing it once
+and wrapping it in an envelope per channel; then times decoding on the
+receiving side. No Redis server is needed.
+
+    python benchmarks/redis_group_fanout.py [--sizes 10 100 10000]
+"""
+from anthill.platform.core.messenger.channels.layers.backends.redis import ChannelLayer
+import argparse
+import time
+
+
+MESSAGE = {
+    "type": "chat.message",
+    "room": "lobby",
+    "text": "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 4,
+    "sender": {"id": 12345, "name": "player", "tags": ["a", "b", "c"]},
+}
+
+
+def per_channel(layer, channel_names):
+    for channel in channel_names:
+        layer.serialize(dict(MESSAGE, __anthill_channel__=channel))
+
+
+def envelope(layer, channel_names):
+    layer._map_channel_to_connection(channel_names, layer.serialize(MESSAGE))
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def run(size, encryption):
+    layer = ChannelLayer(symmetric_encryption_keys=["benchmark-key"] if encryption else None)
+    channel_names = ["specific.%s!%08d" % (layer.client_prefix, i) for i in range(size)]
+    per_channel_time, _ = timed(per_channel, layer, channel_names)
+    envelope_time, connection_to_channels = timed(envelope, layer, channel_names)
+    values = [value for entries in connection_to_channels.values() for _, value, _ in entries]
+    general_channel = "specific.%s!" % layer.client_prefix
+    decode_time, _ = timed(lambda: [layer._decode_received(general_channel, value) for value in values])
+    print("%6d members, encryption %-3s: per channel %9.2f ms  envelope %9.2f ms  (x%5.1f)  decode %9.2f ms" % (
+        size,
+        "on" if encryption else "off",
+        per_channel_time * 1000,
+        envelope_time * 1000,
+        per_channel_time / envelope_time,
+        decode_time * 1000,
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 10000])
+    args = parser.parse_args()
+    for encryption in (False, True):
+        for size in args.sizes:
+            run(size, encryption)
+
+
+if __name__ == "__main__":
+    main()
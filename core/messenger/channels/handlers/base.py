@@ -29,6 +29,13 @@ class ChannelHandlerMixin:
         except AttributeError:
             raise InvalidChannelLayerError("BACKEND is not configured or doesn't support groups")
 
+    async def send_to_channels(self, messages: list) -> None:
+        """Sends the given list of (channel, message) pairs at once."""
+        try:
+            await self.channel_layer.send_many(messages)
+        except AttributeError:
+            raise InvalidChannelLayerError("BACKEND is not configured or doesn't support send_many")
+
     async def send_to_group(self, group: str, message: dict) -> None:
         """Sends the given message to the given group."""
         try:
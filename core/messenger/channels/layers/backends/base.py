@@ -1,3 +1,5 @@
+from anthill.platform.core.messenger.channels.exceptions import ChannelFull
+
 import re
 import fnmatch
 
@@ -13,6 +15,22 @@ class BaseChannelLayer:
         self.capacity = capacity
         self.channel_capacity = channel_capacity or {}
 
+    async def send_many(self, messages):
+        """
+        Sends a list of (channel, message) pairs. Backends supporting the
+        "send_many" extension override this to batch the round trips.
+        Messages for full channels are dropped and the rest still sent;
+        then ChannelFull is raised with the list of full channels.
+        """
+        full_channels = []
+        for channel, message in messages:
+            try:
+                await self.send(channel, message)
+            except ChannelFull:
+                full_channels.append(channel)
+        if full_channels:
+            raise ChannelFull(full_channels)
+
     def compile_capacities(self, channel_capacity):
         """
         Takes an input channel_capacity dict and returns the compiled list
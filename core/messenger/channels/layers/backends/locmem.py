@@ -2,26 +2,90 @@ from anthill.platform.core.messenger.channels.exceptions import ChannelFull
 from anthill.platform.core.messenger.channels.layers.backends.base import BaseChannelLayer
 from copy import deepcopy
 from tornado import queues
+import collections
+import heapq
+import itertools
 import random
 import string
 import time
 
 
+def _read_only(self, *args, **kwargs):
+    raise TypeError("'%s' object is read-only" % type(self).__name__)
+
+
+class FrozenDict(dict):
+    """
+    Read-only dict. Still a dict, so receivers checking for one (or
+    serializing it) take it as it is.
+    """
+
+    __setitem__ = __delitem__ = __ior__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __reduce__(self):
+        # Copies are built whole, not item by item
+        return type(self), (dict(self),)
+
+
+class FrozenList(list):
+    """Read-only list, see FrozenDict."""
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+    append = extend = insert = pop = remove = clear = sort = reverse = _read_only
+
+    def __reduce__(self):
+        return type(self), (list(self),)
+
+
+def freeze(value):
+    """
+    Returns a read-only version of the value: dicts become FrozenDicts,
+    lists and tuples FrozenLists and sets frozensets, recursively.
+    """
+    if isinstance(value, (FrozenDict, FrozenList)):
+        return value
+    if isinstance(value, dict):
+        return FrozenDict((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return FrozenList(freeze(item) for item in value)
+    if isinstance(value, set):
+        return frozenset(value)
+    return value
+
+
 class ChannelLayer(BaseChannelLayer):
     """
-    In-memory channel layer implementation
+    In-memory channel layer implementation.
+    Every receiver gets its own deep copy of a message, unless
+    immutable_messages is set: then a message is frozen once (see freeze)
+    and the same read-only dict is shared by all its receivers.
     """
     local_poll_interval = 0.01
 
-    def __init__(self, expiry=60, group_expiry=86400, capacity=100, channel_capacity=None, **kwargs):
+    def __init__(self, expiry=60, group_expiry=86400, capacity=100, channel_capacity=None,
+                 immutable_messages=False, **kwargs):
         super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        # Share one read-only copy of each message between all its receivers
+        # instead of giving each of them a deep copy
+        self.immutable_messages = immutable_messages
         self.channels = {}
         self.groups = {}
         self.group_expiry = group_expiry
+        # Reverse index of self.groups: channel -> names of its groups
+        self.channel_groups = collections.defaultdict(set)
+        # Heaps of (expiry time, tie breaker, ...) so expired entries are
+        # found without scanning every channel and group
+        self._message_expiry = []
+        self._membership_expiry = []
+        self._counter = itertools.count()
+        # Channels with an entry in _message_expiry; one each, for the
+        # message at the head of the queue, the only one to expire next
+        self._expiry_scheduled = set()
 
     # Channel layer API #
 
-    extensions = ["groups", "flush"]
+    extensions = ["groups", "flush", "send_many"]
 
     async def send(self, channel, message):
         """
@@ -33,16 +97,54 @@ class ChannelLayer(BaseChannelLayer):
         # If it's a process-local channel, strip off local part and stick full name in message
         assert "__anthill_channel__" not in message
 
+        self._put(channel, self._copy_message(message), time.time() + self.expiry)
+
+    async def send_many(self, messages):
+        """
+        Send a list of (channel, message) pairs. Messages to full channels
+        are dropped; once all the others are sent, ChannelFull is raised
+        with the list of those channels.
+        """
+        full_channels = []
+        expires = time.time() + self.expiry
+        for channel, message in messages:
+            # Type check
+            assert isinstance(message, dict), "message is not a dict"
+            assert self.valid_channel_name(channel), "Channel name not valid"
+            assert "__anthill_channel__" not in message
+
+            try:
+                self._put(channel, self._copy_message(message), expires)
+            except ChannelFull:
+                full_channels.append(channel)
+        if full_channels:
+            raise ChannelFull(full_channels)
+
+    def _copy_message(self, message):
+        """
+        Returns the copy of the message handed to a receiver.
+        """
+        if self.immutable_messages:
+            return freeze(message)
+        return deepcopy(message)
+
+    def _put(self, channel, message, expires):
         queue = self.channels.setdefault(channel, queues.Queue())
         # Are we full
         if queue.qsize() >= self.capacity:
             raise ChannelFull(channel)
+        # Add message; queues are unbounded, so this never blocks
+        queue.put_nowait((expires, message))
+        self._schedule_expiry(channel, expires)
 
-        # Add message
-        await queue.put((
-            time.time() + self.expiry,
-            deepcopy(message),
-        ))
+    def _schedule_expiry(self, channel, expires):
+        """
+        Makes sure the channel has an entry in the expiry heap. An entry
+        earlier than the head of the queue just gets renewed when due.
+        """
+        if channel not in self._expiry_scheduled:
+            self._expiry_scheduled.add(channel)
+            heapq.heappush(self._message_expiry, (expires, next(self._counter), channel))
 
     async def receive(self, channel):
         """
@@ -78,37 +180,51 @@ class ChannelLayer(BaseChannelLayer):
 
     def _clean_expired(self):
         """
-        Goes through all messages and groups and removes those that are expired.
+        Removes the messages and group memberships that are expired.
         Any channel with an expired message is removed from all groups.
+        Heap entries of messages already received are renewed for the
+        current head of their queue; those of memberships already renewed
+        or discarded are skipped.
         """
+        now = time.time()
+
         # Channel cleanup
-        for channel, queue in list(self.channels.items()):
+        while self._message_expiry and self._message_expiry[0][0] < now:
+            _, _, channel = heapq.heappop(self._message_expiry)
+            self._expiry_scheduled.discard(channel)
+            queue = self.channels.get(channel)
+            if queue is None:
+                continue
             remove = False
             # See if it's expired
-            while not queue.empty() and queue._queue[0][0] < time.time():
+            while not queue.empty() and queue._queue[0][0] < now:
                 queue.get_nowait()
                 remove = True
             # Any removal prompts group discard
             if remove:
                 self._remove_from_groups(channel)
-            # Is the channel now empty and needs deleting?
-            if not queue:
+            # Is the channel now empty, with nobody waiting on it, and needs deleting?
+            if queue.empty() and not queue._getters:
                 del self.channels[channel]
+            elif not queue.empty():
+                self._schedule_expiry(channel, queue._queue[0][0])
 
         # Group Expiration
-        timeout = int(time.time()) - self.group_expiry
-        for group in self.groups:
-            for channel in list(self.groups.get(group, set())):
-                # If join time is older than group_expiry end the group membership
-                if self.groups[group][channel] and int(self.groups[group][channel]) < timeout:
-                    # Delete from group
-                    del self.groups[group][channel]
+        while self._membership_expiry and self._membership_expiry[0][0] < now:
+            _, _, group, channel, joined = heapq.heappop(self._membership_expiry)
+            # If join time is older than group_expiry end the group membership
+            if self.groups.get(group, {}).get(channel) == joined:
+                self._discard(group, channel)
 
     # Flush extension #
 
     async def flush(self):
         self.channels = {}
         self.groups = {}
+        self.channel_groups.clear()
+        self._message_expiry = []
+        self._membership_expiry = []
+        self._expiry_scheduled = set()
 
     async def close(self):
         # Nothing to go
@@ -118,9 +234,23 @@ class ChannelLayer(BaseChannelLayer):
         """
         Removes a channel from all groups. Used when a message on it expires.
         """
-        for channels in self.groups.values():
-            if channel in channels:
-                del channels[channel]
+        for group in list(self.channel_groups.get(channel, ())):
+            self._discard(group, channel)
+
+    def _discard(self, group, channel):
+        """
+        Removes the channel from the group, keeping the reverse index in step.
+        """
+        channels = self.groups.get(group)
+        if channels is not None:
+            channels.pop(channel, None)
+            if not channels:
+                del self.groups[group]
+        groups = self.channel_groups.get(channel)
+        if groups is not None:
+            groups.discard(group)
+            if not groups:
+                del self.channel_groups[channel]
 
     # Groups extension #
 
@@ -132,29 +262,34 @@ class ChannelLayer(BaseChannelLayer):
         assert self.valid_group_name(group), "Group name not valid"
         assert self.valid_channel_name(channel), "Channel name not valid"
         # Add to group dict
+        joined = time.time()
         self.groups.setdefault(group, {})
-        self.groups[group][channel] = time.time()
+        self.groups[group][channel] = joined
+        self.channel_groups[channel].add(group)
+        heapq.heappush(
+            self._membership_expiry,
+            (joined + self.group_expiry, next(self._counter), group, channel, joined))
 
     async def group_discard(self, group, channel):
         # Both should be text and valid
         assert self.valid_channel_name(channel), "Invalid channel name"
         assert self.valid_group_name(group), "Invalid group name"
         # Remove from group set
-        if group in self.groups:
-            if channel in self.groups[group]:
-                del self.groups[group][channel]
-            if not self.groups[group]:
-                del self.groups[group]
+        self._discard(group, channel)
 
     async def group_send(self, group, message):
         # Check types
         assert isinstance(message, dict), "Message is not a dict"
         assert self.valid_group_name(group), "Invalid group name"
+        assert "__anthill_channel__" not in message
         # Run clean
         self._clean_expired()
+        expires = time.time() + self.expiry
+        # In immutable mode all the members share the same frozen message
+        frozen = freeze(message) if self.immutable_messages else None
         # Send to each channel
-        for channel in self.groups.get(group, set()):
+        for channel in list(self.groups.get(group, ())):
             try:
-                await self.send(channel, message)
+                self._put(channel, frozen if frozen is not None else deepcopy(message), expires)
             except ChannelFull:
                 pass
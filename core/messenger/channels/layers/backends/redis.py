@@ -4,17 +4,52 @@ from anthill.platform.core.messenger.channels.exceptions import ChannelFull
 import asyncio
 import base64
 import binascii
+import bisect
 import collections
 import hashlib
+import hmac
 import itertools
+import math
 import random
 import string
 import time
+import weakref
 
 import aioredis
 import msgpack
 
 
+class HashRing:
+    """
+    Consistent hash ring with virtual nodes.
+    Every node is placed on the ring at a number of points proportional to
+    its weight, and a value belongs to the node of the first point after
+    the value's hash. Adding or removing a node only moves the values
+    falling next to its points.
+    """
+
+    def __init__(self, nodes, virtual_nodes=160):
+        """
+        Takes a list of (name, weight, value) node tuples; get_node returns
+        the value of the owning node. Points only depend on node names,
+        so the order of the list does not matter.
+        """
+        points = []
+        for name, weight, value in nodes:
+            for i in range(max(int(virtual_nodes * weight), 1)):
+                digest = hashlib.md5(("%s-%s" % (name, i)).encode("utf8")).digest()
+                points.append((int.from_bytes(digest[:4], "big"), value))
+        points.sort(key=lambda point: point[0])
+        self.hashes = [point[0] for point in points]
+        self.values = [point[1] for point in points]
+
+    def get_node(self, value):
+        if isinstance(value, str):
+            value = value.encode("utf8")
+        index = bisect.bisect(self.hashes, binascii.crc32(value) & 0xffffffff)
+        return self.values[index % len(self.values)]
+
+
 class ChannelLayer(BaseChannelLayer):
     """
     Redis channel layer.
@@ -25,6 +60,73 @@ class ChannelLayer(BaseChannelLayer):
 
     blpop_timeout = 5
     queue_get_timeout = 10
+    # First byte of messages carrying a routing header, see serialize_envelope
+    envelope_marker = b"\x01"
+    # Bytes of the routing header MAC, when encryption is on
+    envelope_mac_size = 16
+    # Tail of a Fernet token covering its whole HMAC, once base64 encoded
+    envelope_token_tail = 44
+    # Maximum number of messages receive_loop drains per round trip
+    receive_batch_size = 100
+
+    # Lua script doing the capacity check, push and expire of a single
+    # message in one round trip. Returns 0 if the channel is full.
+    send_lua = """
+        if redis.call('LLEN', KEYS[1]) >= tonumber(ARGV[3]) then
+            return 0
+        end
+        redis.call('RPUSH', KEYS[1], ARGV[1])
+        redis.call('EXPIRE', KEYS[1], ARGV[2])
+        return 1
+    """
+
+    # Lua script pushing a message onto each of the channel lists of a
+    # group on one shard. ARGV holds the expiry, then the message for each
+    # key, then the capacity for each key.
+    group_send_lua = """
+        local expiry = ARGV[1]
+        for i=1,#KEYS do
+            if redis.call('LLEN', KEYS[i]) < tonumber(ARGV[i + #KEYS + 1]) then
+                redis.call('RPUSH', KEYS[i], ARGV[i + 1])
+                redis.call('EXPIRE', KEYS[i], expiry)
+            end
+        end
+    """
+
+    # Lua script pushing one message per key, as group_send_lua does, but
+    # reporting for each key whether the message was pushed (1) or the
+    # channel was full (0).
+    send_many_lua = """
+        local expiry = ARGV[1]
+        local result = {}
+        for i=1,#KEYS do
+            if redis.call('LLEN', KEYS[i]) < tonumber(ARGV[i + #KEYS + 1]) then
+                redis.call('RPUSH', KEYS[i], ARGV[i + 1])
+                redis.call('EXPIRE', KEYS[i], expiry)
+                result[i] = 1
+            else
+                result[i] = 0
+            end
+        end
+        return result
+    """
+
+    # Lua script atomically popping up to ARGV[1] messages off the list.
+    receive_many_lua = """
+        local messages = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+        if #messages > 0 then
+            redis.call('LTRIM', KEYS[1], #messages, -1)
+        end
+        return messages
+    """
+
+    # Lua script deleting all keys matching the pattern in ARGV[1].
+    flush_lua = """
+        local keys = redis.call('keys', ARGV[1])
+        for i=1,#keys,5000 do
+            redis.call('del', unpack(keys, i, math.min(i+4999, #keys)))
+        end
+    """
 
     def __init__(
             self,
@@ -35,6 +137,13 @@ class ChannelLayer(BaseChannelLayer):
             capacity=100,
             channel_capacity=None,
             symmetric_encryption_keys=None,
+            pool_minsize=1,
+            pool_maxsize=10,
+            receive_pool_maxsize=100,
+            health_check_interval=30,
+            group_cache_ttl=None,
+            virtual_nodes=160,
+            previous_hosts=None,
     ):
         # Store basic information
         self.expiry = expiry
@@ -46,12 +155,47 @@ class ChannelLayer(BaseChannelLayer):
         # Cached redis connection pools and the event loop they are from
         self.pools = {}
         self.pools_loop = None
+        self.pools_locks = {}
+        self.pool_minsize = pool_minsize
+        self.pool_maxsize = pool_maxsize
+        # Reads blocking until a message arrives take connections from
+        # pools of their own, so they cannot use up those of other commands
+        self.receive_pool_maxsize = receive_pool_maxsize
+        # Idle connections older than this are pinged before being handed out
+        self.health_check_interval = health_check_interval
+        self._last_used = weakref.WeakKeyDictionary()
+        # SHA1 digests of the Lua scripts, for EVALSHA
+        self._script_shas = {}
+        # Local group membership cache (disabled if no TTL is given), kept
+        # coherent by pub/sub notifications sent on group_add/group_discard
+        self.group_cache_ttl = group_cache_ttl
+        self.group_cache = {}
+        self._group_cache_generation = 0
+        self._group_cache_listeners = {}
+        self._group_cache_subscribed = set()
         # Configure the host objects
-        self.hosts = self.decode_hosts(hosts)
+        hosts = self.decode_hosts(hosts)
+        self.hosts = [self._connection_kwargs(host) for host in hosts]
+        self.ring = self._make_ring(hosts, range(len(hosts)), virtual_nodes)
+        send_indexes = range(len(self.hosts))
+        # While resharding, the hosts before the change are read from too
+        self.previous_ring = None
+        if previous_hosts:
+            previous = self.decode_hosts(previous_hosts)
+            # Same server whatever its weight before and now
+            addresses = [self._host_address(host) for host in self.hosts]
+            indexes = []
+            for host in previous:
+                address = self._host_address(host)
+                if address not in addresses:
+                    self.hosts.append(self._connection_kwargs(host))
+                    addresses.append(address)
+                indexes.append(addresses.index(address))
+            self.previous_ring = self._make_ring(previous, indexes, virtual_nodes)
         self.ring_size = len(self.hosts)
         # Normal channels choose a host index by cycling through the available hosts
         self._receive_index_generator = itertools.cycle(range(len(self.hosts)))
-        self._send_index_generator = itertools.cycle(range(len(self.hosts)))
+        self._send_index_generator = itertools.cycle(send_indexes)
         # Decide on a unique client prefix to use in ! sections
         # TODO: ensure uniqueness better, e.g. Redis keys with SETNX
         self.client_prefix = "".join(random.choice(string.ascii_letters) for i in range(8))
@@ -80,9 +224,37 @@ class ChannelLayer(BaseChannelLayer):
         # Decode each hosts entry into a kwargs dict
         result = []
         for entry in hosts:
-            result.append({"address": entry})
+            if isinstance(entry, dict):
+                result.append(dict(entry))
+            else:
+                result.append({"address": entry})
         return result
 
+    @staticmethod
+    def _host_address(host):
+        address = host["address"]
+        if isinstance(address, (list, tuple)):
+            address = "%s:%s" % tuple(address)
+        return address
+
+    @staticmethod
+    def _connection_kwargs(host):
+        """
+        Returns the Redis connection kwargs of the host entry, which is
+        the entry itself without its ring "weight".
+        """
+        return {key: value for key, value in host.items() if key != "weight"}
+
+    def _make_ring(self, hosts, indexes, virtual_nodes):
+        """
+        Builds the hash ring of the hosts, mapping to the given host indexes.
+        Host entries may carry a "weight" (default 1).
+        """
+        nodes = []
+        for host, index in zip(hosts, indexes):
+            nodes.append((self._host_address(host), host.get("weight", 1), index))
+        return HashRing(nodes, virtual_nodes)
+
     def _setup_encryption(self, symmetric_encryption_keys):
         # See if we can do encryption if they asked
         if symmetric_encryption_keys:
@@ -94,12 +266,15 @@ class ChannelLayer(BaseChannelLayer):
                 raise ValueError("Cannot run with encryption without 'cryptography' installed.")
             sub_fernets = [self.make_fernet(key) for key in symmetric_encryption_keys]
             self.crypter = MultiFernet(sub_fernets)
+            # Routing headers are out of the token, so they get a MAC of their own
+            self.envelope_keys = [self.make_envelope_key(key) for key in symmetric_encryption_keys]
         else:
             self.crypter = None
+            self.envelope_keys = []
 
     # Channel layer API #
 
-    extensions = ["groups", "flush"]
+    extensions = ["groups", "flush", "send_many"]
 
     async def send(self, channel, message):
         """
@@ -110,28 +285,81 @@ class ChannelLayer(BaseChannelLayer):
         assert self.valid_channel_name(channel), "Channel name not valid"
         # Make sure the message does not contain reserved keys
         assert "__anthill_channel__" not in message
-        # If it's a process-local channel, strip off local part and stick full name in message
+        await self._send_body(channel, self.serialize(message))
+
+    async def _send_body(self, channel, body):
+        """
+        Sends the serialized message onto the channel.
+        """
+        # If it's a process-local channel, strip off local part and stick full name in envelope
         channel_non_local_name = channel
+        value = body
         if "!" in channel:
-            message = dict(message.items())
-            message["__anthill_channel__"] = channel
+            value = self.serialize_envelope(channel, value)
             channel_non_local_name = self.non_local_name(channel)
         # Write out message into expiring key (avoids big items in list)
         channel_key = self.prefix + channel_non_local_name
         # Pick a connection to the right server - consistent for specific
         # channels, random for general channels
         if "!" in channel:
-            index = self.consistent_hash(channel)
+            index = self.consistent_hash(channel_non_local_name)
         else:
             index = next(self._send_index_generator)
         async with self.connection(index) as connection:
-            # Check the length of the list before send
-            # This can allow the list to leak slightly over capacity, but that's fine.
-            if await connection.llen(channel_key) >= self.get_capacity(channel):
+            # Check the length of the list, push onto the list then set it
+            # to expire in case it's not consumed, atomically
+            pushed = await self.run_script(
+                connection,
+                self.send_lua,
+                keys=[channel_key],
+                args=[value, int(self.expiry), self.get_capacity(channel)]
+            )
+            if not pushed:
                 raise ChannelFull()
-            # Push onto the list then set it to expire in case it's not consumed
-            await connection.rpush(channel_key, self.serialize(message))
-            await connection.expire(channel_key, int(self.expiry))
+
+    async def send_many(self, messages):
+        """
+        Send a list of (channel, message) pairs, using one round trip per shard.
+        Messages to full channels are dropped; once all the others are sent,
+        ChannelFull is raised with the list of those channels.
+        """
+        bodies = []
+        for channel, message in messages:
+            # Type check
+            assert isinstance(message, dict), "message is not a dict"
+            assert self.valid_channel_name(channel), "Channel name not valid"
+            # Make sure the message does not contain reserved keys
+            assert "__anthill_channel__" not in message
+            bodies.append((channel, self.serialize(message)))
+        await self._send_many_bodies(bodies)
+
+    async def _send_many_bodies(self, bodies):
+        """
+        Sends a list of (channel, serialized message) pairs, as send_many.
+        """
+        shard_to_items = collections.defaultdict(list)
+        for channel, body in bodies:
+            channel_non_local_name = channel
+            value = body
+            if "!" in channel:
+                value = self.serialize_envelope(channel, value)
+                channel_non_local_name = self.non_local_name(channel)
+                index = self.consistent_hash(channel_non_local_name)
+            else:
+                index = next(self._send_index_generator)
+            shard_to_items[index].append((channel, self.prefix + channel_non_local_name, value))
+
+        full_channels = []
+        for index, items in shard_to_items.items():
+            keys = [channel_key for _, channel_key, _ in items]
+            args = [int(self.expiry)]
+            args += [value for _, _, value in items]
+            args += [self.get_capacity(channel) for channel, _, _ in items]
+            async with self.connection(index) as connection:
+                pushed = await self.run_script(connection, self.send_many_lua, keys=keys, args=args)
+            full_channels.extend(channel for (channel, _, _), ok in zip(items, pushed) if not ok)
+        if full_channels:
+            raise ChannelFull(full_channels)
 
     async def receive(self, channel):
         """
@@ -192,8 +420,32 @@ class ChannelLayer(BaseChannelLayer):
         """
         assert general_channel.endswith("!"), "receive_loop not called on general queue of process-local channel"
         while True:
-            real_channel, message = await self.receive_single(general_channel)
-            await self.receive_buffer[real_channel].put(message)
+            for real_channel, message in await self.receive_many(general_channel, self.receive_batch_size):
+                await self.receive_buffer[real_channel].put(message)
+
+    def _receive_index(self, channel):
+        """
+        Works out the connection index to receive off of the channel with.
+        """
+        if "!" in channel:
+            assert channel.endswith("!")
+            return self.consistent_hash(channel)
+        return next(self._receive_index_generator)
+
+    def _decode_received(self, channel, content):
+        """
+        Decodes the received message and returns it together with its
+        full channel name.
+        """
+        full_channel, message = self.deserialize_envelope(content)
+        # TODO: message expiry?
+        if full_channel is not None:
+            return full_channel, message
+        # Messages from older senders store the full channel name in the message.
+        if "__anthill_channel__" in message:
+            channel = message["__anthill_channel__"]
+            del message["__anthill_channel__"]
+        return channel, message
 
     async def receive_single(self, channel):
         """
@@ -201,26 +453,58 @@ class ChannelLayer(BaseChannelLayer):
         """
         # Check channel name
         assert self.valid_channel_name(channel, receive=True), "Channel name invalid"
-        # Work out the connection to use
-        if "!" in channel:
-            assert channel.endswith("!")
-            index = self.consistent_hash(channel)
-        else:
-            index = next(self._receive_index_generator)
-        # Get that connection and receive off of it
-        async with self.connection(index) as connection:
+        # Get the right connection and receive off of it
+        async with self.connection(self._receive_index(channel), blocking=True) as connection:
             channel_key = self.prefix + channel
             content = None
             while content is None:
                 content = await connection.blpop(channel_key, timeout=self.blpop_timeout)
-            # Message decode
-            message = self.deserialize(content[1])
-            # TODO: message expiry?
-            # If there is a full channel name stored in the message, unpack it.
-            if "__anthill_channel__" in message:
-                channel = message["__anthill_channel__"]
-                del message["__anthill_channel__"]
-            return channel, message
+            return self._decode_received(channel, content[1])
+
+    async def receive_many(self, channel, max_messages=None, timeout=None):
+        """
+        Receives up to max_messages messages off of the channel and returns
+        them as a list of (channel, message) pairs. Already queued messages
+        are drained in one round trip; if there are none, waits for the first
+        one to arrive, forever or for at most timeout seconds (in which case
+        the returned list may be empty).
+        """
+        # Check channel name
+        assert self.valid_channel_name(channel, receive=True), "Channel name invalid"
+        max_messages = max_messages or self.receive_batch_size
+        channel_key = self.prefix + channel
+        # While resharding, first take what is left on the previous shard
+        previous_index = self._previous_index(channel)
+        if previous_index is not None:
+            async with self.connection(previous_index) as connection:
+                contents = await self.run_script(
+                    connection, self.receive_many_lua, keys=[channel_key], args=[max_messages])
+            if contents:
+                return [self._decode_received(channel, content) for content in contents]
+            # Do not block for long, so the previous shard is checked again soon
+            if timeout is None:
+                timeout = self.blpop_timeout
+        # Get the right connection and receive off of it
+        async with self.connection(self._receive_index(channel), blocking=True) as connection:
+            contents = await self.run_script(
+                connection, self.receive_many_lua, keys=[channel_key], args=[max_messages])
+            if not contents:
+                # Nothing queued, block until something arrives
+                if timeout is None:
+                    content = None
+                    while content is None:
+                        content = await connection.blpop(channel_key, timeout=self.blpop_timeout)
+                else:
+                    # BLPOP takes whole seconds only, and 0 means forever
+                    content = await connection.blpop(channel_key, timeout=max(int(math.ceil(timeout)), 1))
+                    if content is None:
+                        return []
+                contents = [content[1]]
+                if max_messages > 1:
+                    # Pick up whatever arrived along with it
+                    contents += await self.run_script(
+                        connection, self.receive_many_lua, keys=[channel_key], args=[max_messages - 1])
+        return [self._decode_received(channel, content) for content in contents]
 
     async def new_channel(self, prefix="specific"):
         """
@@ -240,21 +524,11 @@ class ChannelLayer(BaseChannelLayer):
         """
         Deletes all messages and groups on all shards.
         """
-        # Lua deletion script
-        delete_prefix = """
-            local keys = redis.call('keys', ARGV[1])
-            for i=1,#keys,5000 do
-                redis.call('del', unpack(keys, i, math.min(i+4999, #keys)))
-            end
-        """
+        self._invalidate_group_cache()
         # Go through each connection and remove all with prefix
         for i in range(self.ring_size):
             async with self.connection(i) as connection:
-                await connection.eval(
-                    delete_prefix,
-                    keys=[],
-                    args=[self.prefix + "*"]
-                )
+                await self.run_script(connection, self.flush_lua, args=[self.prefix + "*"])
 
     # Groups extension #
 
@@ -277,6 +551,7 @@ class ChannelLayer(BaseChannelLayer):
             # Set expiration to be group_expiry, since everything in
             # it at this point is guaranteed to expire before that
             await connection.expire(group_key, self.group_expiry)
+            await self._publish_group_change(connection, group)
 
     async def group_discard(self, group, channel):
         """
@@ -288,6 +563,12 @@ class ChannelLayer(BaseChannelLayer):
         key = self._group_key(group)
         async with self.connection(self.consistent_hash(group)) as connection:
             await connection.zrem(key, channel)
+            await self._publish_group_change(connection, group)
+        # While resharding, the membership may still be on the previous shard
+        previous_index = self._previous_index(group)
+        if previous_index is not None:
+            async with self.connection(previous_index) as connection:
+                await connection.zrem(key, channel)
 
     async def group_send(self, group, message):
         """
@@ -295,75 +576,134 @@ class ChannelLayer(BaseChannelLayer):
         """
         assert self.valid_group_name(group), "Group name not valid"
         # Retrieve list of all channel names
-        key = self._group_key(group)
-        async with self.connection(self.consistent_hash(group)) as connection:
-            # Discard old channels based on group_expiry
-            await connection.zremrangebyscore(key, min=0, max=int(time.time()) - self.group_expiry)
-
-            # Return current lot
-            channel_names = [x.decode("utf8") for x in await connection.zrange(key, 0, -1)]
-
-        connection_to_channels, channel_to_message, channel_to_capacity, channel_to_key = \
-            self._map_channel_to_connection(channel_names, message)
-
-        for connection_index, channel_redis_keys in connection_to_channels.items():
-            # Create a LUA script specific for this connection.
-            # Make sure to use the message specific to this channel, it is
-            # stored in channel_to_message dict and contains the
-            # __anthill_channel__ key.
-            group_send_lua = """
-                for i=1,#KEYS do
-                    if redis.call('LLEN', KEYS[i]) < tonumber(ARGV[i + #KEYS]) then
-                        redis.call('RPUSH', KEYS[i], ARGV[i])
-                        redis.call('EXPIRE', KEYS[i], %d)
-                    end
-                end
-            """ % self.expiry
-
-            # We need to filter the messages to keep those related to the connection
-            args = [
-                channel_to_message[channel_name] for channel_name in channel_names
-                if channel_to_key[channel_name] in channel_redis_keys
-            ]
+        channel_names = await self.group_channels(group)
+        await self._send_to_channels(channel_names, self.serialize(message))
 
+    async def _send_to_channels(self, channel_names, body):
+        """
+        Sends the serialized message to each of the channels, dropping it
+        for the full ones, with one round trip per shard.
+        """
+        connection_to_channels = self._map_channel_to_connection(channel_names, body)
+
+        for connection_index, entries in connection_to_channels.items():
+            # Make sure to use the value specific to each channel, it
+            # carries the full channel name in its envelope.
+            channel_redis_keys = [channel_key for channel_key, _, _ in entries]
+            args = [int(self.expiry)]
+            args += [value for _, value, _ in entries]
             # We need to send the capacity for each channel
-            args += [
-                channel_to_capacity[channel_name] for channel_name in channel_names
-                if channel_to_key[channel_name] in channel_redis_keys
-            ]
+            args += [capacity for _, _, capacity in entries]
 
             async with self.connection(connection_index) as connection:
-                await connection.eval(group_send_lua, keys=channel_redis_keys, args=args)
+                await self.run_script(connection, self.group_send_lua, keys=channel_redis_keys, args=args)
 
-    def _map_channel_to_connection(self, channel_names, message):
+    async def group_channels(self, group):
+        """
+        Returns the names of the channels in the group, from the local
+        group cache if it is enabled and holds a fresh entry.
+        """
+        index = self.consistent_hash(group)
+        use_cache = self.group_cache_ttl and self._group_cache_listening(index)
+        if use_cache:
+            entry = self.group_cache.get(group)
+            if entry is not None and entry[0] > time.time():
+                return entry[1]
+        generation = self._group_cache_generation
+        key = self._group_key(group)
+        indexes = [index]
+        # While resharding, members may still be on the previous shard
+        previous_index = self._previous_index(group)
+        if previous_index is not None:
+            indexes.append(previous_index)
+        channel_names = []
+        for i in indexes:
+            async with self.connection(i) as connection:
+                # Discard old channels based on group_expiry
+                await connection.zremrangebyscore(key, min=0, max=int(time.time()) - self.group_expiry)
+
+                # Return current lot
+                channel_names += [x.decode("utf8") for x in await connection.zrange(key, 0, -1)]
+        if len(indexes) > 1:
+            channel_names = list(collections.OrderedDict.fromkeys(channel_names))
+        # Do not cache if the membership changed while we were reading it
+        if use_cache and generation == self._group_cache_generation:
+            self.group_cache[group] = (time.time() + self.group_cache_ttl, channel_names)
+        return channel_names
+
+    def _group_cache_channel(self):
+        """
+        Name of the pub/sub channel group changes are announced on.
+        """
+        return "%s:group_changes" % self.prefix
+
+    async def _publish_group_change(self, connection, group):
+        if self.group_cache_ttl:
+            self._invalidate_group_cache(group)
+            await connection.publish(self._group_cache_channel(), group)
+
+    def _invalidate_group_cache(self, group=None):
+        self._group_cache_generation += 1
+        if group is None:
+            self.group_cache.clear()
+        else:
+            self.group_cache.pop(group, None)
+
+    def _group_cache_listening(self, index):
+        """
+        Makes sure the shard's group change listener runs and returns whether
+        it is subscribed, that is whether cached entries can be trusted.
+        """
+        task = self._group_cache_listeners.get(index)
+        if task is None or task.done():
+            loop = asyncio.get_event_loop()
+            self._group_cache_listeners[index] = loop.create_task(self._group_cache_listener(index))
+        return index in self._group_cache_subscribed
+
+    async def _group_cache_listener(self, index):
+        """
+        Drops group cache entries as changes are announced on the shard.
+        """
+        conn = None
+        try:
+            # Subscribed connections cannot run other commands, so this
+            # one stays out of the pool
+            conn = await aioredis.create_connection(**self.hosts[index])
+            channel, = await aioredis.Redis(conn).subscribe(self._group_cache_channel())
+            self._group_cache_subscribed.add(index)
+            while await channel.wait_message():
+                group = await channel.get()
+                self._invalidate_group_cache(group.decode("utf8"))
+        except (aioredis.RedisError, OSError):
+            # Changes may have been missed; the listener is restarted
+            # by the next group_send
+            pass
+        finally:
+            self._group_cache_subscribed.discard(index)
+            self._invalidate_group_cache()
+            if conn is not None:
+                conn.close()
+
+    def _map_channel_to_connection(self, channel_names, body):
         """
         For a list of channel names, bucket each one to a dict keyed by the
-        connection index.
-        Also for each channel create a message specific to that channel, adding
-        the __anthill_channel__ key to the message.
-        We also return a mapping from channel names to their corresponding Redis
-        keys, and a mapping of channels to their capacity.
+        connection index, as a list of (Redis key, value, capacity) entries.
+        All channels get the same serialized body; process-local channels
+        get it wrapped in an envelope carrying their full name.
         """
         connection_to_channels = collections.defaultdict(list)
-        channel_to_message = dict()
-        channel_to_capacity = dict()
-        channel_to_key = dict()
 
         for channel in channel_names:
             channel_non_local_name = channel
+            value = body
             if "!" in channel:
-                message = dict(message.items())
-                message["__anthill_channel__"] = channel
+                value = self.serialize_envelope(channel, body)
                 channel_non_local_name = self.non_local_name(channel)
             channel_key = self.prefix + channel_non_local_name
             idx = self.consistent_hash(channel_non_local_name)
-            connection_to_channels[idx].append(channel_key)
-            channel_to_capacity[channel] = self.get_capacity(message)
-            channel_to_message[channel] = self.serialize(message)
-            # We build a
-            channel_to_key[channel] = channel_key
+            connection_to_channels[idx].append((channel_key, value, self.get_capacity(channel)))
 
-        return connection_to_channels, channel_to_message, channel_to_capacity, channel_to_key
+        return connection_to_channels
 
     def _group_key(self, group):
         """
@@ -387,21 +727,94 @@ class ChannelLayer(BaseChannelLayer):
         Deserializes from a byte string.
         """
         if self.crypter:
-            message = self.crypter.decrypt(message, self.expiry + 10)
+            message = self.crypter.decrypt(bytes(message), self.expiry + 10)
         return msgpack.unpackb(message, raw=False)
 
+    def serialize_envelope(self, channel, body):
+        """
+        Wraps an already serialized message with the full name of the
+        process-local channel it is for, so fan-out serializes the body once.
+        Layout: marker byte, name length byte, UTF-8 name, [MAC,] body.
+        The name is not encrypted; with encryption on, it is followed by
+        a MAC binding it to the encrypted body, so that the message cannot
+        be readdressed to another channel.
+        """
+        name = channel.encode("utf8")
+        parts = [self.envelope_marker, bytes((len(name),)), name]
+        if self.envelope_keys:
+            parts.append(self._envelope_mac(self.envelope_keys[0], name, body))
+        parts.append(body)
+        return b"".join(parts)
+
+    def deserialize_envelope(self, value):
+        """
+        Splits an enveloped byte string into the channel name and the
+        deserialized message, without copying the body.
+        Returns None as the channel name for values without an envelope.
+        """
+        if value[:1] != self.envelope_marker:
+            return None, self.deserialize(value)
+        view = memoryview(value)
+        end = 2 + view[1]
+        name = bytes(view[2:end])
+        if self.envelope_keys:
+            mac = bytes(view[end:end + self.envelope_mac_size])
+            end += self.envelope_mac_size
+            body = view[end:]
+            if not any(hmac.compare_digest(mac, self._envelope_mac(key, name, body))
+                       for key in self.envelope_keys):
+                raise ValueError("Message routing header does not match its MAC")
+        return name.decode("utf8"), self.deserialize(view[end:])
+
+    def _envelope_mac(self, key, name, body):
+        # The token tail holds the token HMAC, binding the MAC to the
+        # whole token without hashing it again for every channel
+        data = name + bytes(body[-self.envelope_token_tail:])
+        return hmac.new(key, data, hashlib.sha256).digest()[:self.envelope_mac_size]
+
     # Internal functions #
 
+    def script_sha(self, script):
+        """
+        Returns the SHA1 digest Redis uses to identify the given Lua script.
+        """
+        sha = self._script_shas.get(script)
+        if sha is None:
+            sha = self._script_shas[script] = hashlib.sha1(script.encode("utf8")).hexdigest()
+        return sha
+
+    async def run_script(self, connection, script, keys=None, args=None):
+        """
+        Runs the Lua script by its SHA with EVALSHA, falling back to a full
+        EVAL (which also loads it into the script cache of that server) if
+        the server does not know the script yet.
+        """
+        keys = keys or []
+        args = args or []
+        try:
+            return await connection.evalsha(self.script_sha(script), keys=keys, args=args)
+        except aioredis.ReplyError as e:
+            if not str(e).startswith("NOSCRIPT"):
+                raise
+            return await connection.eval(script, keys=keys, args=args)
+
     def consistent_hash(self, value):
         """
-        Maps the value to a node value between 0 and 4095
-        using CRC, then down to one of the ring nodes.
+        Maps the value to the index of the host owning it on the hash ring.
         """
-        if isinstance(value, str):
-            value = value.encode("utf8")
-        bigval = binascii.crc32(value) & 0xfff
-        ring_divisor = 4096 / float(self.ring_size)
-        return int(bigval / ring_divisor)
+        return self.ring.get_node(value)
+
+    def _previous_index(self, value):
+        """
+        While resharding, returns the index of the host which owned the
+        value before, if that is another host; None otherwise.
+        """
+        if self.previous_ring is None:
+            return None
+        index = self.previous_ring.get_node(value)
+        if index == self.ring.get_node(value):
+            return None
+        return index
 
     def make_fernet(self, key):
         """
@@ -413,33 +826,121 @@ class ChannelLayer(BaseChannelLayer):
         formatted_key = base64.urlsafe_b64encode(hashlib.sha256(key).digest())
         return Fernet(formatted_key)
 
+    def make_envelope_key(self, key):
+        """
+        Given a single encryption key, returns the key for routing header
+        MACs, derived apart from the Fernet one.
+        """
+        if isinstance(key, str):
+            key = key.encode("utf8")
+        return hashlib.sha256(b"anthill-envelope:" + key).digest()
+
     def __str__(self):
         return "%s(hosts=%s)" % (self.__class__.__name__, self.hosts)
 
     # Connection handling #
 
-    def connection(self, index):
+    def connection(self, index, blocking=False):
         """
         Returns the correct connection for the index given.
-        Lazily instantiates pools.
+        Lazily instantiates pools. Set blocking for commands which may
+        block until a message arrives.
         """
         # Catch bad indexes
         if not 0 <= index < self.ring_size:
             raise ValueError("There are only %s hosts - you asked for %s!" % (self.ring_size, index))
         # Make a context manager
-        return self.ConnectionContextManager(self.hosts[index])
+        return self.ConnectionContextManager(self, index, blocking)
+
+    async def get_pool(self, index, blocking=False):
+        """
+        Returns the connection pool for the shard index given, creating it
+        on first use; blocking reads have pools of their own. Pools are bound
+        to the event loop they were created on, so a change of loop drops
+        the previous set of pools.
+        """
+        loop = asyncio.get_event_loop()
+        if self.pools_loop is not loop:
+            for pool in self.pools.values():
+                pool.close()
+            self.pools = {}
+            self.pools_locks = {}
+            self.pools_loop = loop
+        key = (index, blocking)
+        pool = self.pools.get(key)
+        if pool is None or pool.closed:
+            lock = self.pools_locks.setdefault(key, asyncio.Lock())
+            async with lock:
+                pool = self.pools.get(key)
+                if pool is None or pool.closed:
+                    pool = await aioredis.create_pool(
+                        minsize=self.pool_minsize,
+                        maxsize=self.receive_pool_maxsize if blocking else self.pool_maxsize,
+                        **self.hosts[index]
+                    )
+                    self.pools[key] = pool
+        return pool
+
+    async def acquire(self, pool):
+        """
+        Takes a connection out of the pool, pinging it first if it
+        has been idle for longer than `health_check_interval`.
+        """
+        while True:
+            conn = await pool.acquire()
+            last_used = self._last_used.get(conn)
+            if last_used is None or time.time() - last_used < self.health_check_interval:
+                return conn
+            try:
+                await conn.execute(b"PING")
+            except (aioredis.RedisError, OSError):
+                # Broken connection, drop it and take the next one
+                conn.close()
+                pool.release(conn)
+            else:
+                return conn
+
+    def release(self, pool, conn, discard=False):
+        """
+        Returns the connection to the pool. Connections which may have
+        a pending reply (e.g. a cancelled BLPOP) must be discarded.
+        """
+        if discard:
+            conn.close()
+        else:
+            self._last_used[conn] = time.time()
+        pool.release(conn)
+
+    async def close(self):
+        """
+        Closes the group cache listeners and all connection pools.
+        """
+        listeners, self._group_cache_listeners = self._group_cache_listeners, {}
+        for task in listeners.values():
+            task.cancel()
+        pools, self.pools = self.pools, {}
+        for pool in pools.values():
+            pool.close()
+        for pool in pools.values():
+            await pool.wait_closed()
 
     class ConnectionContextManager:
         """
-        Async context manager for connections
+        Async context manager for pooled connections
         """
 
-        def __init__(self, kwargs):
-            self.kwargs = kwargs
+        def __init__(self, layer, index, blocking=False):
+            self.layer = layer
+            self.index = index
+            self.blocking = blocking
+            self.pool = None
+            self.conn = None
 
         async def __aenter__(self):
-            self.conn = await aioredis.create_redis(**self.kwargs)
-            return self.conn
+            self.pool = await self.layer.get_pool(self.index, self.blocking)
+            self.conn = await self.layer.acquire(self.pool)
+            return aioredis.Redis(self.conn)
 
         async def __aexit__(self, exc_type, exc, tb):
-            self.conn.close()
+            discard = exc_type is not None and not issubclass(exc_type, ChannelFull)
+            self.layer.release(self.pool, self.conn, discard=discard)
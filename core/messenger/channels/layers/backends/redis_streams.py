@@ -0,0 +1,236 @@
+from anthill.platform.core.messenger.channels.layers.backends.redis import ChannelLayer as RedisChannelLayer
+
+import time
+
+import aioredis
+
+
+class ChannelLayer(RedisChannelLayer):
+    """
+    Redis Streams channel layer.
+    Works like the Redis channel layer, but every channel is a stream
+    read through a consumer group, so a message stays pending until the
+    receiver acknowledges it and is reclaimed by another consumer if the
+    receiver dies first. Channel capacity is enforced by trimming the
+    stream with MAXLEN, so a full channel drops its oldest entries
+    instead of raising ChannelFull.
+    Entries of general channels are acknowledged once handed out to the
+    receiver; those of process-local channels as soon as they are read,
+    since their stream has no other consumer to reclaim them.
+    """
+
+    consumer_group = "anthill"
+    message_field = b"m"
+
+    # Same arguments as the Redis channel layer scripts, see there.
+    send_lua = """
+        redis.call('XADD', KEYS[1], 'MAXLEN', ARGV[3], '*', 'm', ARGV[1])
+        redis.call('EXPIRE', KEYS[1], ARGV[2])
+        return 1
+    """
+
+    group_send_lua = """
+        local expiry = ARGV[1]
+        for i=1,#KEYS do
+            redis.call('XADD', KEYS[i], 'MAXLEN', ARGV[i + #KEYS + 1], '*', 'm', ARGV[i + 1])
+            redis.call('EXPIRE', KEYS[i], expiry)
+        end
+    """
+
+    send_many_lua = """
+        local expiry = ARGV[1]
+        local result = {}
+        for i=1,#KEYS do
+            redis.call('XADD', KEYS[i], 'MAXLEN', ARGV[i + #KEYS + 1], '*', 'm', ARGV[i + 1])
+            redis.call('EXPIRE', KEYS[i], expiry)
+            result[i] = 1
+        end
+        return result
+    """
+
+    def __init__(self, reclaim_idle=None, reclaim_interval=5, **kwargs):
+        super().__init__(**kwargs)
+        # Entries pending on another consumer for longer than this many
+        # seconds are taken over; defaults to the message expiry
+        self.reclaim_idle = reclaim_idle if reclaim_idle is not None else self.expiry
+        # Minimum number of seconds between two reclaim passes on a stream
+        self.reclaim_interval = reclaim_interval
+        self._last_reclaim = {}
+        # Ids of the entries of general channels received but not
+        # acknowledged yet, by (connection index, stream key)
+        self._unacked = {}
+
+    async def receive_single(self, channel):
+        """
+        Receives a single message off of the channel and returns it.
+        """
+        # Handed out right away, so acknowledged as soon as read
+        return (await self._receive_entries(channel, 1, None, ack=True))[0]
+
+    async def receive_many(self, channel, max_messages=None, timeout=None):
+        """
+        Receives up to max_messages messages off of the channel and returns
+        them as a list of (channel, message) pairs.
+        Entries of a general channel are acknowledged by the next call for
+        the channel, the caller being done handing them out by then.
+        Entries left pending by dead consumers are reclaimed first; then
+        waits for new ones, forever or for at most timeout seconds (in which
+        case the returned list may be empty).
+        """
+        # Check channel name
+        assert self.valid_channel_name(channel, receive=True), "Channel name invalid"
+        await self._ack_previous(self.prefix + channel)
+        return await self._receive_entries(channel, max_messages, timeout, ack="!" in channel)
+
+    async def _receive_entries(self, channel, max_messages, timeout, ack):
+        """
+        Reads up to max_messages entries off of the channel and decodes
+        them. They are acknowledged right away if ack is set, otherwise
+        left for _ack_previous.
+        """
+        max_messages = max_messages or self.receive_batch_size
+        previous_index = self._previous_index(channel)
+        while True:
+            if previous_index is not None:
+                # While resharding, first take what is left on the previous shard
+                received = await self._read_entries(
+                    previous_index, channel, max_messages, None, ack, previous=True)
+                if received:
+                    return received
+                if timeout is None:
+                    # Do not block for long, so the previous shard is checked again soon
+                    received = await self._read_entries(
+                        self._receive_index(channel), channel, max_messages, self.blpop_timeout, ack)
+                    if received:
+                        return received
+                    continue
+            return await self._read_entries(self._receive_index(channel), channel, max_messages, timeout, ack)
+
+    async def _read_entries(self, index, channel, max_messages, timeout, ack, previous=False):
+        """
+        Reads and decodes up to max_messages entries of the channel on the
+        shard index, as _receive_entries does. On a previous shard, only
+        takes entries already there, without blocking.
+        """
+        stream_key = self.prefix + channel
+        if previous:
+            async with self.connection(index) as connection:
+                if not await connection.exists(stream_key):
+                    return []
+                entries = await self._reclaim(connection, stream_key, max_messages)
+                if not entries:
+                    entries = await self._read_group(connection, stream_key, max_messages, None)
+                return await self._decode_entries(connection, index, channel, entries, ack)
+        # Get the right connection and receive off of it
+        async with self.connection(index, blocking=True) as connection:
+            entries = await self._reclaim(connection, stream_key, max_messages)
+            if not entries:
+                if timeout is None:
+                    while not entries:
+                        entries = await self._read_group(connection, stream_key, max_messages, self.blpop_timeout)
+                else:
+                    entries = await self._read_group(connection, stream_key, max_messages, timeout)
+            return await self._decode_entries(connection, index, channel, entries, ack)
+
+    async def _decode_entries(self, connection, index, channel, entries, ack):
+        """
+        Decodes the entries read off of the channel on the shard index, then
+        acknowledges them, or leaves them for _ack_previous.
+        """
+        if not entries:
+            return []
+        stream_key = self.prefix + channel
+        received = [self._decode_received(channel, self._entry_value(fields)) for _, fields in entries]
+        entry_ids = [entry_id for entry_id, _ in entries]
+        if ack:
+            await connection.execute(b"XACK", stream_key, self.consumer_group, *entry_ids)
+        else:
+            self._unacked.setdefault((index, stream_key), []).extend(entry_ids)
+        return received
+
+    async def _ack_previous(self, stream_key):
+        """
+        Acknowledges the entries of the stream received last, each on the
+        shard it was read from.
+        """
+        for index in range(self.ring_size):
+            entry_ids = self._unacked.pop((index, stream_key), None)
+            if entry_ids:
+                async with self.connection(index) as connection:
+                    await connection.execute(b"XACK", stream_key, self.consumer_group, *entry_ids)
+
+    def _entry_value(self, fields):
+        """
+        Picks the message out of the flat field/value list of a stream entry.
+        """
+        for i in range(0, len(fields), 2):
+            if fields[i] == self.message_field:
+                return fields[i + 1]
+        raise ValueError("Stream entry has no message field")
+
+    async def _create_group(self, connection, stream_key):
+        """
+        Creates the consumer group of the stream, starting from its first
+        entry so nothing sent before the first receive is skipped.
+        """
+        try:
+            await connection.execute(
+                b"XGROUP", b"CREATE", stream_key, self.consumer_group, b"0", b"MKSTREAM")
+        except aioredis.ReplyError as e:
+            if not str(e).startswith("BUSYGROUP"):
+                raise
+        else:
+            await connection.expire(stream_key, int(self.expiry))
+
+    async def _read_group(self, connection, stream_key, count, timeout):
+        """
+        Reads up to count new entries for this consumer, blocking for at
+        most timeout seconds, or not at all if timeout is None.
+        Returns a list of (id, fields) pairs.
+        """
+        args = [b"GROUP", self.consumer_group, self.client_prefix, b"COUNT", count]
+        if timeout is not None:
+            # BLOCK 0 means forever
+            args += [b"BLOCK", max(int(timeout * 1000), 1)]
+        args += [b"STREAMS", stream_key, b">"]
+        try:
+            reply = await connection.execute(b"XREADGROUP", *args)
+        except aioredis.ReplyError as e:
+            # The stream (and its group) does not exist yet, or has expired
+            if not str(e).startswith("NOGROUP"):
+                raise
+            await self._create_group(connection, stream_key)
+            reply = await connection.execute(b"XREADGROUP", *args)
+        if not reply:
+            return []
+        return reply[0][1]
+
+    async def _reclaim(self, connection, stream_key, count):
+        """
+        Takes over up to count entries idle for longer than reclaim_idle on
+        other consumers of the stream. Runs at most every reclaim_interval
+        seconds per stream. Returns a list of (id, fields) pairs.
+        """
+        now = time.time()
+        if now - self._last_reclaim.get(stream_key, 0) < self.reclaim_interval:
+            return []
+        self._last_reclaim[stream_key] = now
+        min_idle = int(self.reclaim_idle * 1000)
+        try:
+            pending = await connection.execute(
+                b"XPENDING", stream_key, self.consumer_group, b"-", b"+", count)
+        except aioredis.ReplyError as e:
+            if not str(e).startswith("NOGROUP"):
+                raise
+            return []
+        consumer = self.client_prefix.encode("utf8")
+        entry_ids = [
+            entry_id for entry_id, owner, idle, _ in pending
+            if idle >= min_idle and owner != consumer
+        ]
+        if not entry_ids:
+            return []
+        entries = await connection.execute(
+            b"XCLAIM", stream_key, self.consumer_group, self.client_prefix, min_idle, *entry_ids)
+        # Entries trimmed away meanwhile come back empty
+        return [entry for entry in entries if entry and entry[1]]
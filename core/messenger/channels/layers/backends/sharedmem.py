@@ -0,0 +1,351 @@
+from anthill.platform.core.messenger.channels.layers.backends.redis import ChannelLayer as RedisChannelLayer
+from anthill.platform.core.messenger.channels.exceptions import ChannelFull
+
+from contextlib import contextmanager
+import asyncio
+import fcntl
+import mmap
+import os
+import stat
+import struct
+import tempfile
+
+
+class RingBuffer:
+    """
+    Multi-producer, single-consumer ring buffer of length-prefixed records
+    in a memory-mapped file. Writers and the reader serialize on an
+    exclusive flock of the file, held only while copying records in or out.
+    Next to the file, a named pipe wakes the reader up: writers write a
+    byte into it after each record.
+    """
+
+    # Owner process id, write position, read position. Positions only
+    # ever grow; their offset in the data area is taken modulo its size.
+    header = struct.Struct("=QQQ")
+    record_header = struct.Struct("=I")
+
+    def __init__(self, path, size=None):
+        """
+        Opens the ring buffer file at path or, if size is given, creates it
+        with that many bytes of data area, owned by the current process.
+        """
+        self.path = path
+        self.wakeup_path = path + ".wakeup"
+        if size is not None:
+            # The pipe comes first, writers open it once they find the file
+            try:
+                os.unlink(self.wakeup_path)
+            except FileNotFoundError:
+                pass
+            os.mkfifo(self.wakeup_path, 0o600)
+            # Read and write, so that it neither blocks nor sees end of file
+            # when writers come and go
+            self.wakeup_fd = os.open(self.wakeup_path, os.O_RDWR | os.O_NONBLOCK)
+            # Build it aside and move it in place, so nobody maps a half made file
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            os.ftruncate(fd, self.header.size + size)
+            os.pwrite(fd, self.header.pack(os.getpid(), 0, 0), 0)
+            os.rename(tmp_path, path)
+        else:
+            fd = os.open(path, os.O_RDWR)
+            try:
+                self.wakeup_fd = os.open(self.wakeup_path, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError:
+                # No reader anymore
+                os.close(fd)
+                raise FileNotFoundError(self.wakeup_path)
+        self.fd = fd
+        self.mmap = mmap.mmap(fd, 0)
+        self.size = len(self.mmap) - self.header.size
+
+    @contextmanager
+    def locked(self):
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def owner_alive(self):
+        """
+        Returns whether the process which created the ring still runs.
+        """
+        pid = self.header.unpack_from(self.mmap, 0)[0]
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def put(self, value):
+        """
+        Appends the byte string; returns False if there is no room for it.
+        """
+        length = self.record_header.size + len(value)
+        with self.locked():
+            pid, write_pos, read_pos = self.header.unpack_from(self.mmap, 0)
+            if write_pos - read_pos + length > self.size:
+                return False
+            self._write(write_pos, self.record_header.pack(len(value)))
+            self._write(write_pos + self.record_header.size, value)
+            self.header.pack_into(self.mmap, 0, pid, write_pos + length, read_pos)
+        try:
+            os.write(self.wakeup_fd, b"\0")
+        except OSError:
+            # The pipe is full, so the reader is to wake up anyway, or gone
+            pass
+        return True
+
+    def clear_wakeups(self):
+        """
+        Empties the wakeup pipe; done by the reader before reading records.
+        """
+        try:
+            while os.read(self.wakeup_fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def get_many(self, max_records):
+        """
+        Pops up to max_records byte strings, oldest first.
+        """
+        _, write_pos, read_pos = self.header.unpack_from(self.mmap, 0)
+        if write_pos == read_pos:
+            # Nothing to read, no need to take the lock
+            return []
+        values = []
+        with self.locked():
+            pid, write_pos, read_pos = self.header.unpack_from(self.mmap, 0)
+            while read_pos < write_pos and len(values) < max_records:
+                length, = self.record_header.unpack(self._read(read_pos, self.record_header.size))
+                values.append(self._read(read_pos + self.record_header.size, length))
+                read_pos += self.record_header.size + length
+            self.header.pack_into(self.mmap, 0, pid, write_pos, read_pos)
+        return values
+
+    def _write(self, pos, data):
+        start = self.header.size + pos % self.size
+        first = min(len(data), self.header.size + self.size - start)
+        self.mmap[start:start + first] = data[:first]
+        if first < len(data):
+            # Wrap around to the start of the data area
+            self.mmap[self.header.size:self.header.size + len(data) - first] = data[first:]
+
+    def _read(self, pos, length):
+        start = self.header.size + pos % self.size
+        first = min(length, self.header.size + self.size - start)
+        data = self.mmap[start:start + first]
+        if first < length:
+            data += self.mmap[self.header.size:self.header.size + length - first]
+        return data
+
+    def close(self, unlink=False):
+        self.mmap.close()
+        os.close(self.fd)
+        os.close(self.wakeup_fd)
+        if unlink:
+            for path in (self.path, self.wakeup_path):
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+
+
+class ChannelLayer(RedisChannelLayer):
+    """
+    Shared memory channel layer.
+    Works like the Redis channel layer, but messages for process-local
+    channels of another layer on the same host are written straight into
+    its ring buffer file instead of going through Redis. Each layer owns
+    one ring buffer per general process-local channel name (the part up
+    to the !), kept in a directory shared by the processes of the host.
+    General channels, group membership and remote process-local channels
+    still go through Redis, but the group cache is required, so that
+    group sends to local members (internal requests among them) need no
+    network hop once the membership is cached.
+    """
+
+    # Maximum number of names remembered as not local to this host
+    remote_cache_size = 10000
+
+    def __init__(self, directory=None, buffer_size=1024 * 1024, group_cache_ttl=60, **kwargs):
+        if not group_cache_ttl:
+            raise ValueError("The shared memory channel layer needs the group cache (group_cache_ttl).")
+        super().__init__(group_cache_ttl=group_cache_ttl, **kwargs)
+        if directory is None:
+            base = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+            directory = os.path.join(base, "anthill")
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        # Anyone able to get in could read and inject messages
+        st = os.lstat(directory)
+        if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+            raise PermissionError(
+                "%s must be a directory owned by this user and closed to others." % directory)
+        self.directory = directory
+        # Size in bytes of the data area of our ring buffers
+        self.buffer_size = buffer_size
+        # Ring buffers we read from, and those of other local processes we write to
+        self.own_rings = {}
+        self.peer_rings = {}
+        self._remote_names = set()
+
+    def _ring_path(self, channel_non_local_name):
+        return os.path.join(self.directory, self.prefix + channel_non_local_name)
+
+    def own_ring(self, channel_non_local_name):
+        """
+        Returns the ring buffer this layer receives the channel on, creating it.
+        """
+        ring = self.own_rings.get(channel_non_local_name)
+        if ring is None:
+            ring = RingBuffer(self._ring_path(channel_non_local_name), size=self.buffer_size)
+            self.own_rings[channel_non_local_name] = ring
+        return ring
+
+    def peer_ring(self, channel_non_local_name):
+        """
+        Returns the ring buffer of the local layer owning the channel, or
+        None if the channel lives on another host.
+        """
+        ring = self.own_rings.get(channel_non_local_name) or self.peer_rings.get(channel_non_local_name)
+        if ring is None:
+            if channel_non_local_name in self._remote_names:
+                return None
+            try:
+                ring = RingBuffer(self._ring_path(channel_non_local_name))
+            except (FileNotFoundError, ValueError):
+                if len(self._remote_names) >= self.remote_cache_size:
+                    self._remote_names.clear()
+                self._remote_names.add(channel_non_local_name)
+                return None
+            self.peer_rings[channel_non_local_name] = ring
+        if not ring.owner_alive():
+            # Left behind by a dead process
+            del self.peer_rings[channel_non_local_name]
+            ring.close(unlink=True)
+            return None
+        return ring
+
+    def local_ring(self, channel):
+        """
+        Returns the ring buffer to write messages for the channel into, or
+        None if they have to go through Redis.
+        """
+        if "!" not in channel:
+            return None
+        return self.peer_ring(self.non_local_name(channel))
+
+    # Channel layer API #
+
+    async def send(self, channel, message):
+        """
+        Send a message onto a (general or specific) channel.
+        """
+        # Type check
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        # Make sure the message does not contain reserved keys
+        assert "__anthill_channel__" not in message
+        body = self.serialize(message)
+        ring = self.local_ring(channel)
+        if ring is None:
+            await self._send_body(channel, body)
+        elif not ring.put(self.serialize_envelope(channel, body)):
+            raise ChannelFull()
+
+    async def send_many(self, messages):
+        """
+        Send a list of (channel, message) pairs, writing those for local
+        channels into their ring buffers and sending the rest through Redis.
+        """
+        full_channels = []
+        remote = []
+        for channel, message in messages:
+            # Type check
+            assert isinstance(message, dict), "message is not a dict"
+            assert self.valid_channel_name(channel), "Channel name not valid"
+            # Make sure the message does not contain reserved keys
+            assert "__anthill_channel__" not in message
+            body = self.serialize(message)
+            ring = self.local_ring(channel)
+            if ring is None:
+                remote.append((channel, body))
+            elif not ring.put(self.serialize_envelope(channel, body)):
+                full_channels.append(channel)
+        if remote:
+            try:
+                await self._send_many_bodies(remote)
+            except ChannelFull as e:
+                full_channels.extend(e.args[0])
+        if full_channels:
+            raise ChannelFull(full_channels)
+
+    async def _send_to_channels(self, channel_names, body):
+        """
+        Sends the serialized message to each of the channels, dropping it
+        for the full ones; local channels get it through their ring buffers.
+        """
+        remote = []
+        for channel in channel_names:
+            ring = self.local_ring(channel)
+            if ring is None:
+                remote.append(channel)
+            else:
+                ring.put(self.serialize_envelope(channel, body))
+        if remote:
+            await super()._send_to_channels(remote, body)
+
+    async def new_channel(self, prefix="specific"):
+        """
+        Returns a new channel name that can be used by something in our
+        process as a specific channel.
+        """
+        channel = await super().new_channel(prefix)
+        # Local senders look for the ring buffer, so it has to exist first
+        self.own_ring(self.non_local_name(channel))
+        return channel
+
+    async def receive_loop(self, general_channel):
+        """
+        Continuous-receiving loop filling the receive buffer from both the
+        ring buffer of the channel and Redis.
+        """
+        ring = self.own_ring(general_channel)
+        loop = asyncio.get_event_loop()
+        wakeup = asyncio.Event()
+        loop.add_reader(ring.wakeup_fd, wakeup.set)
+        remote = asyncio.ensure_future(super().receive_loop(general_channel))
+        remote.add_done_callback(lambda _: wakeup.set())
+        try:
+            while True:
+                # Wakeups for records written from now on stay in the pipe
+                wakeup.clear()
+                ring.clear_wakeups()
+                values = ring.get_many(self.receive_batch_size)
+                for value in values:
+                    real_channel, message = self._decode_received(general_channel, value)
+                    await self.receive_buffer[real_channel].put(message)
+                if remote.done():
+                    # Propagate a dead Redis receiver
+                    remote.result()
+                if not values:
+                    await wakeup.wait()
+        finally:
+            loop.remove_reader(ring.wakeup_fd)
+            remote.cancel()
+
+    async def close(self):
+        """
+        Removes our ring buffers, then closes the Redis connections.
+        """
+        own_rings, self.own_rings = self.own_rings, {}
+        for ring in own_rings.values():
+            ring.close(unlink=True)
+        peer_rings, self.peer_rings = self.peer_rings, {}
+        for ring in peer_rings.values():
+            ring.close()
+        await super().close()
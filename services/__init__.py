@@ -6,15 +6,18 @@ from anthill.framework.utils.geoip import GeoIP2
 from anthill.framework.core.servers import BaseService as _BaseService
 from anthill.framework.core.cache import caches
 from anthill.platform.services.update import manager
+from anthill.platform.services.failure_detector import PhiAccrualFailureDetector
 from anthill.platform.utils.celery import CeleryMixin
 from anthill.platform.core.messenger.message import MessengerClient
+from anthill.platform.core.messenger.channels.exceptions import InvalidChannelLayerError
 from anthill.platform.api.internal import (
     JSONRPCInternalConnection, RequestTimeoutError, RequestError, as_internal)
 from socketio.exceptions import ConnectionError
-from tornado.ioloop import PeriodicCallback
+from tornado.ioloop import IOLoop, PeriodicCallback
 from psutil import virtual_memory, cpu_percent
 from functools import partial
 from tornado.web import url
+import asyncio
 import logging
 
 logger = logging.getLogger('anthill.application')
@@ -36,6 +39,7 @@ class HeartbeatReport:
 class MasterRole:
     """Mixin class for enabling `master` role on service."""
     heartbeat_interval = 10
+    heartbeat_max_concurrency = 10
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -55,12 +59,13 @@ class MasterRole:
         return list(res.keys())
 
     async def heartbeat_request(self):
-        for controller in await self.get_controllers():
-            try:
-                report = await self.internal_request(controller, 'heartbeat_report')
+        controllers = await self.get_controllers()
+        reports = await self.internal_gather_requests(
+            [(controller, 'heartbeat_report', {}) for controller in controllers],
+            deadline=self.heartbeat_interval, max_concurrency=self.heartbeat_max_concurrency)
+        for controller, report in zip(controllers, reports):
+            if not isinstance(report, Exception):
                 report = HeartbeatReport(**report)
-            except RequestError as e:
-                report = e
             await self.heartbeat_callback(controller, report)
 
     async def heartbeat_callback(self, controller, report):
@@ -159,6 +164,8 @@ def _url_pattern(url_, float_slash=True):
 class BaseService(CeleryMixin, _BaseService):
     internal_api_connection_class = JSONRPCInternalConnection
     check_updates_period = 5 * 60  # 5 min
+    # Channel group discovery publishes registry changes to
+    registry_group_name = 'discovery-registry'
 
     def __init__(self, handlers=None, default_host=None, transforms=None, **kwargs):
         self.gis = None
@@ -176,6 +183,10 @@ class BaseService(CeleryMixin, _BaseService):
     def internal_request(self):
         return self.internal_connection.request
 
+    @property
+    def internal_gather_requests(self):
+        return self.internal_connection.gather_requests
+
     @property
     def uptime(self):
         if self.started_at is not None:
@@ -260,12 +271,33 @@ class PlainService(BaseService):
     discovery_name = 'discovery'
     message_name = 'message'
     admin_name = 'admin'
+    # Seconds discovered services are fresh, then served stale while
+    # being refreshed, and missing services are remembered for
+    discover_cache_ttl = 30
+    discover_stale_ttl = 300
+    discover_negative_ttl = 5
 
     def __init__(self, handlers=None, default_host=None, transforms=None, **kwargs):
         super().__init__(handlers, default_host, transforms, **kwargs)
         self.messenger_client = None
+        # Version of the local registry replica, None until synced
+        self.registry_version = None
+        self._registry_syncing = False
+        # (version, name, networks) changes arrived while syncing
+        self._registry_changes = []
+        # (fresh until, stale until, result) and pending requests by (name, network)
+        self._discover_cache = {}
+        self._discover_requests = {}
+
+    @staticmethod
+    def setup_registry_api():
+        @as_internal()
+        async def update_registry(api, version, name, networks=None, **options):
+            await api.service.update_registry(version, name, networks)
 
     def setup(self) -> None:
+        # Own name, not to be shadowed by setup_internal_api of role mixins
+        self.setup_registry_api()
         super().setup()
         self.settings.update(messenger_url=None)
         self.settings.update(registered_services={})
@@ -289,13 +321,108 @@ class PlainService(BaseService):
         logger.info('Disconnected from `discovery` service.')
 
     async def discover(self, name: str, network: str = None) -> dict:
-        return await self.discovery_request('get_service', name=name, network=network)
+        now = IOLoop.current().time()
+        fresh_until, stale_until, result = self._discover_cache.get((name, network), (0, 0, None))
+        if now >= stale_until:
+            result = await self._discover_request(name, network)
+        elif now >= fresh_until:
+            # Serve the stale one, refresh in the background
+            self._discover_request(name, network)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def _discover_request(self, name: str, network: str = None):
+        """
+        Requests the service from discovery, unless the same request is
+        already in flight. Returns the future of the result, or of the
+        error instead of raising it.
+        """
+        key = (name, network)
+        future = self._discover_requests.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._discover_fetch(name, network))
+            self._discover_requests[key] = future
+            future.add_done_callback(lambda f: self._discover_requests.pop(key, None))
+        return future
+
+    async def _discover_fetch(self, name: str, network: str = None):
+        key = (name, network)
+        try:
+            # Freshness is managed here, not by the internal request cache
+            result = await self.discovery_request(
+                'get_service', name=name, network=network, caching=False)
+        except RequestTimeoutError as e:
+            # Transient, a stale entry is better than nothing
+            return e
+        except RequestError as e:
+            result, ttl, stale_ttl = e, self.discover_negative_ttl, 0
+        except Exception as e:
+            # Nobody may be waiting for a background refresh, so do not raise
+            logger.error('Cannot discover service `%s`. %s' % (name, str(e)))
+            return e
+        else:
+            ttl, stale_ttl = self.discover_cache_ttl, self.discover_stale_ttl
+        now = IOLoop.current().time()
+        self._discover_cache[key] = (now + ttl, now + ttl + stale_ttl, result)
+        return result
+
+    def forget_discovered(self, name: str) -> None:
+        """Drops the discovered service from the cache."""
+        for key in [key for key in self._discover_cache if key[0] == name]:
+            del self._discover_cache[key]
 
     @method_decorator(retry(max_retries=0, delay=3, exception_types=(RequestError,),
                             on_exception=lambda func, e: logger.error('Cannot get registered services. Retry...'), ))
     async def set_registered_services(self) -> None:
-        registered_services = await self.discovery_request('get_registered_services')
-        self.settings.update(registered_services=registered_services)
+        self._registry_syncing = True
+        try:
+            snapshot = await self.discovery_request('get_registry_snapshot', caching=False)
+            self.settings.update(registered_services=snapshot['services'])
+            self.registry_version = snapshot['version']
+        finally:
+            self._registry_syncing = False
+        # Changes published after the snapshot was taken may have come first
+        changes, self._registry_changes = self._registry_changes, []
+        for version, name, networks in sorted(changes, key=lambda change: change[0]):
+            await self.update_registry(version, name, networks)
+
+    async def sync_registry(self) -> None:
+        """Replaces the local registry replica with a fresh snapshot."""
+        if self._registry_syncing:
+            return
+        self._registry_syncing = True
+        try:
+            await self.set_registered_services()
+        finally:
+            self._registry_syncing = False
+
+    async def update_registry(self, version: int, name: str, networks: dict = None) -> None:
+        """
+        Applies a registry change published by discovery to the local
+        replica: the service networks, or its removal if networks is None.
+        """
+        if self.registry_version is None or self._registry_syncing:
+            # May be newer than the snapshot, applied once it is in
+            self._registry_changes.append((version, name, networks))
+            return
+        if version <= self.registry_version:
+            # Already applied
+            return
+        if version > self.registry_version + 1:
+            logger.warning('Registry changes missed (%s => %s). Resync...' % (
+                self.registry_version, version))
+            # Not from here: the snapshot response comes through the
+            # same message loop as this update
+            IOLoop.current().add_callback(self.sync_registry)
+            return
+        registered_services = self.settings['registered_services']
+        if networks is None:
+            registered_services.pop(name, None)
+        else:
+            registered_services[name] = networks
+        self.registry_version = version
+        self.forget_discovered(name)
 
     @method_decorator(retry(max_retries=0, delay=3, exception_types=(RequestError,),
                             on_exception=lambda func, e: logger.error('Cannot get login url. Retry...'), ))
@@ -319,6 +446,8 @@ class PlainService(BaseService):
 
     async def on_start(self) -> None:
         await super().on_start()
+        # Subscribe before the snapshot, so no change falls in between
+        await self.internal_connection.group_add(self.registry_group_name)
         if self.auto_register_on_discovery:
             await self.register_on_discovery()
         await self.set_registered_services()
@@ -335,6 +464,7 @@ class PlainService(BaseService):
 class AdminService(PlainService):
     update_services_meta_period = 5
     update_services_meta = True
+    services_meta_max_concurrency = 10
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -357,14 +487,17 @@ class AdminService(PlainService):
         except RequestTimeoutError:
             pass  # ¯\_(ツ)_/¯
         else:
-            for name in services_names:
-                if name in exclude_names:
-                    continue
-                try:
-                    metadata = await self.internal_request(name, method='get_service_metadata')
+            names = [name for name in services_names if name not in exclude_names]
+            # Slow services must not hold up the next refresh
+            results = await self.internal_gather_requests(
+                [(name, 'get_service_metadata', {}) for name in names],
+                deadline=self.update_services_meta_period,
+                max_concurrency=self.services_meta_max_concurrency)
+            for name, metadata in zip(names, results):
+                if isinstance(metadata, Exception):
+                    logger.debug('Cannot get service `%s` metadata. %s' % (name, str(metadata)))
+                else:
                     services_metadata.append(metadata)
-                except RequestTimeoutError:
-                    pass  # ¯\_(ツ)_/¯
         return services_metadata
 
     @method_decorator(retry(max_retries=0, delay=3, exception_types=(RequestError,),
@@ -397,6 +530,13 @@ class DiscoveryService(BaseService):
     ping_services = True
     ping_max_retries = 1
     ping_timeout = 1
+    ping_max_concurrency = 10
+    # Services are removed once their suspicion level reaches the threshold
+    suspicion_threshold = 8
+    # Seconds of failed pings tolerated before suspicion starts to grow
+    acceptable_ping_pause = 2 * cleanup_services_period
+    failure_detector_class = PhiAccrualFailureDetector
+    registry_version_key = '__registry_version__'
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -407,6 +547,42 @@ class DiscoveryService(BaseService):
             self.ping_monitor = None
         self.registry = self.app.registry
         self.storage = caches['services']
+        # Duration of the last services check and ping round trip time
+        # by service name, in seconds
+        self.sweep_duration = None
+        self.services_rtt = {}
+        # Successful pings are the heartbeats
+        self.failure_detector = self.failure_detector_class(
+            threshold=self.suspicion_threshold,
+            min_std_deviation=self.ping_timeout,
+            acceptable_heartbeat_pause=self.acceptable_ping_pause,
+            first_heartbeat_estimate=self.cleanup_services_period)
+
+    @staticmethod
+    def setup_discovery_api():
+        @as_internal()
+        async def get_discovery_metrics(api, **options):
+            return {
+                'sweep_duration': api.service.sweep_duration,
+                'services_rtt': api.service.services_rtt
+            }
+
+        @as_internal()
+        async def get_registry_snapshot(api, **options):
+            return await api.service.get_registry_snapshot()
+
+        @as_internal()
+        async def get_services_suspicion(api, **options):
+            detector = api.service.failure_detector
+            return {
+                name: {'phi': phi, 'available': phi < detector.threshold}
+                for name, phi in detector.suspicion_levels().items()
+            }
+
+    def setup(self):
+        # Own name, not to be shadowed by setup_internal_api of role mixins
+        self.setup_discovery_api()
+        super().setup()
 
     async def on_start(self) -> None:
         await super().on_start()
@@ -419,35 +595,91 @@ class DiscoveryService(BaseService):
         if self.ping_monitor is not None:
             self.ping_monitor.stop()
 
-    @method_decorator(retry(max_retries=ping_max_retries, delay=0,
-                            exception_types=(RequestTimeoutError, KeyError, TypeError)))
-    async def is_service_alive(self, name):
-        internal_request = partial(self.internal_request, name)
-        try:
-            response = await internal_request('ping', timeout=self.ping_timeout)
-            return response['message'] == 'pong'
-        except Exception as e:
-            logger.error('Service `%s` is unreachable. %s' % (name, str(e)))
-            raise
+    async def check_alive_services(self, names) -> dict:
+        """Pings the services concurrently, returns their liveness by name."""
+        alive = {}
+        for _ in range(self.ping_max_retries + 1):
+            names = [name for name in names if not alive.get(name)]
+            if not names:
+                break
+
+            def on_ping(i, response, elapsed):
+                name = names[i]
+                try:
+                    alive[name] = response['message'] == 'pong'
+                except (KeyError, TypeError):
+                    logger.error('Service `%s` is unreachable. %s' % (name, str(response)))
+                    alive[name] = False
+                if alive[name]:
+                    self.services_rtt[name] = elapsed
+                else:
+                    self.services_rtt.pop(name, None)
+
+            await self.internal_gather_requests(
+                [(name, 'ping', {}) for name in names],
+                timeout=self.ping_timeout, max_concurrency=self.ping_max_concurrency,
+                callback=on_ping, caching=False)
+        return alive
 
     async def check_services(self):
-        for name in self.registry.keys():
-            if name == self.name:
-                # Prevent self pinging
-                continue
-            if not await self.is_service_alive(name):
-                await self.remove_service(name)
-            else:
-                if name not in await self.list_services():
+        # Prevent self pinging
+        names = [name for name in self.registry.keys() if name != self.name]
+        started = IOLoop.current().time()
+        alive = await self.check_alive_services(names)
+        registered_names = set(await self.list_services())
+        for name in names:
+            if alive[name]:
+                self.failure_detector.heartbeat(name)
+                if name not in registered_names:
                     await self.setup_service(name, self.registry[name])
+            else:
+                # A service never answered is suspected from now on
+                self.failure_detector.watch(name)
+                # Keep it until it is genuinely down, not on a single failed ping
+                if name in registered_names and not self.failure_detector.is_available(name):
+                    logger.warning('Service `%s` is down, phi %.2f.' % (
+                        name, self.failure_detector.phi(name)))
+                    await self.remove_service(name)
+        for name in set(self.failure_detector) - set(names):
+            # No longer in the registry
+            self.failure_detector.remove(name)
+        for name in set(self.services_rtt) - set(names):
+            del self.services_rtt[name]
+        self.sweep_duration = IOLoop.current().time() - started
+        logger.debug('Services checked in %.3f sec.' % self.sweep_duration)
 
     async def setup_services(self, cleanup=False) -> None:
         if cleanup:
             await self.remove_services()
         self.storage.set_many(self.registry, timeout=None)
+        for name, networks in self.registry.items():
+            await self.publish_registry_change(name, networks)
 
     async def remove_services(self) -> None:
         self.storage.delete_many(keys=self.registry.keys())
+        for name in self.registry.keys():
+            await self.publish_registry_change(name)
+
+    def current_registry_version(self) -> int:
+        return self.storage.get(self.registry_version_key, 0)
+
+    def next_registry_version(self) -> int:
+        # Kept in the storage, so it grows across restarts
+        self.storage.add(self.registry_version_key, 0, timeout=None)
+        return self.storage.incr(self.registry_version_key)
+
+    async def publish_registry_change(self, name: str, networks: dict = None) -> None:
+        """Publishes the service networks, or its removal if networks is None."""
+        kwargs = dict(version=self.next_registry_version(), name=name, networks=networks)
+        try:
+            await self.internal_connection.push(self.registry_group_name, 'update_registry', **kwargs)
+        except InvalidChannelLayerError as e:
+            logger.error('Cannot publish registry change. %s' % str(e))
+
+    async def get_registry_snapshot(self) -> dict:
+        # Version first: changes made meanwhile come again with newer ones
+        version = self.current_registry_version()
+        return {'version': version, 'services': await self.get_services()}
 
     async def list_services(self) -> list:
         """Returns a list of services names."""
@@ -455,17 +687,20 @@ class DiscoveryService(BaseService):
 
     async def setup_service(self, name: str, networks: dict) -> None:
         self.storage.set(name, networks, timeout=None)
+        await self.publish_registry_change(name, networks)
 
     async def remove_service(self, name: str) -> None:
         self.storage.delete(name)
+        await self.publish_registry_change(name)
 
     async def is_service_exists(self, name: str) -> bool:
         return name in self.storage
 
     async def get_service(self, name: str, networks: list = None) -> dict:
-        if not await self.is_service_exists(name):
+        service = self.storage.get(name)
+        if service is None:
             raise ServiceDoesNotExist(name)
-        return dict_filter(self.storage.get(name), keys=networks)
+        return dict_filter(service, keys=networks)
 
     async def get_services(self) -> dict:
         return self.storage.get_many(keys=self.registry.keys())
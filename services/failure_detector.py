@@ -0,0 +1,126 @@
+import collections
+import math
+import sys
+import time
+
+
+class HeartbeatHistory:
+    """Bounded window of heartbeat inter-arrival intervals."""
+
+    def __init__(self, max_sample_size):
+        self.intervals = collections.deque(maxlen=max_sample_size)
+        self._sum = 0.0
+        self._squared_sum = 0.0
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def add(self, interval):
+        if len(self.intervals) == self.intervals.maxlen:
+            dropped = self.intervals[0]
+            self._sum -= dropped
+            self._squared_sum -= dropped ** 2
+        self.intervals.append(interval)
+        self._sum += interval
+        self._squared_sum += interval ** 2
+
+    @property
+    def mean(self):
+        return self._sum / len(self.intervals)
+
+    @property
+    def variance(self):
+        return max(self._squared_sum / len(self.intervals) - self.mean ** 2, 0.0)
+
+    @property
+    def std_deviation(self):
+        return math.sqrt(self.variance)
+
+
+class PhiAccrualFailureDetector:
+    """
+    Phi accrual failure detector (Hayashibara et al.).
+    Instead of a plain alive/dead answer, it gives for every watched name
+    a suspicion level phi, which grows with the time since its last
+    heartbeat, scaled by the history of its heartbeat inter-arrival times.
+    phi = 1 means about 10% chance of a false suspicion, phi = 2 about 1%,
+    and so on. A name is considered unavailable once phi reaches threshold.
+    """
+
+    def __init__(self, threshold=8.0, max_sample_size=200, min_std_deviation=0.5,
+                 acceptable_heartbeat_pause=0.0, first_heartbeat_estimate=1.0,
+                 clock=time.monotonic):
+        self.threshold = threshold
+        self.max_sample_size = max_sample_size
+        # Seconds; keeps phi from soaring on a too regular history
+        self.min_std_deviation = min_std_deviation
+        # Seconds of missing heartbeats tolerated on top of the usual interval
+        self.acceptable_heartbeat_pause = acceptable_heartbeat_pause
+        # Expected interval in seconds, until there is a history to go by
+        self.first_heartbeat_estimate = first_heartbeat_estimate
+        self.clock = clock
+        self.histories = {}
+        self.last_heartbeats = {}
+
+    def __contains__(self, name):
+        return name in self.last_heartbeats
+
+    def __iter__(self):
+        return iter(self.last_heartbeats)
+
+    def _new_history(self):
+        # Bootstrap with two intervals around the first estimate
+        history = HeartbeatHistory(self.max_sample_size)
+        std_deviation = self.first_heartbeat_estimate / 4
+        history.add(self.first_heartbeat_estimate - std_deviation)
+        history.add(self.first_heartbeat_estimate + std_deviation)
+        return history
+
+    def heartbeat(self, name):
+        """Records a heartbeat of name arrived now."""
+        now = self.clock()
+        last_heartbeat = self.last_heartbeats.get(name)
+        if last_heartbeat is None:
+            self.histories[name] = self._new_history()
+        else:
+            self.histories[name].add(now - last_heartbeat)
+        self.last_heartbeats[name] = now
+
+    def watch(self, name):
+        """
+        Starts watching name, as if it had just sent a heartbeat, unless it
+        is already watched. For names never heard of, so that their
+        silence starts counting.
+        """
+        if name not in self.last_heartbeats:
+            self.heartbeat(name)
+
+    def remove(self, name):
+        self.histories.pop(name, None)
+        self.last_heartbeats.pop(name, None)
+
+    def phi(self, name):
+        """Suspicion level of name; 0 for names not watched."""
+        last_heartbeat = self.last_heartbeats.get(name)
+        if last_heartbeat is None:
+            return 0.0
+        history = self.histories[name]
+        elapsed = self.clock() - last_heartbeat
+        mean = history.mean + self.acceptable_heartbeat_pause
+        std_deviation = max(history.std_deviation, self.min_std_deviation)
+        # Logistic approximation of the normal cumulative distribution
+        y = (elapsed - mean) / std_deviation
+        # Capped to keep exp from overflowing far below the mean
+        e = math.exp(min(-y * (1.5976 + 0.070566 * y * y), 700.0))
+        if elapsed > mean:
+            p = e / (1.0 + e)
+        else:
+            p = 1.0 - 1.0 / (1.0 + e)
+        return -math.log10(max(p, sys.float_info.min))
+
+    def is_available(self, name):
+        return self.phi(name) < self.threshold
+
+    def suspicion_levels(self):
+        """Returns phi by watched name."""
+        return {name: self.phi(name) for name in self.last_heartbeats}
@@ -86,7 +86,7 @@ setup(
         'python-socketio'
     ],
     extras_require={
-
+        'amqp': ['aio-pika>=7.0'],
     },
     zip_safe=False,
     classifiers=[